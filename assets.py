@@ -0,0 +1,94 @@
+import base64
+import hashlib
+import io
+import os
+import tempfile
+import threading
+from functools import lru_cache
+
+try:
+    from PIL import Image
+except ImportError:  # optional, variants are then plain copies of the originals
+    Image = None
+
+SOURCE_DIR = 'static/img'
+CACHE_DIR = 'static/cache'
+# Files under ./static are served by Streamlit at /app/static/ when enableStaticServing is on
+STATIC_URL = 'app/static/cache/'
+
+# name -> (max width in px, WebP quality). The map is shown at most 400 px wide, so 800 covers 2x screens.
+VARIANTS = {
+    'map.png': (800, 78),
+    'logo.png': (600, 85),
+}
+PORTRAIT = (256, 85)
+
+_build_lock = threading.Lock()
+
+
+def _variant_params(name):
+    return VARIANTS.get(name, PORTRAIT)
+
+
+def _encode(path, width, quality):
+    if Image is None:
+        with open(path, 'rb') as f:
+            return f.read(), os.path.splitext(path)[1]
+
+    with Image.open(path) as im:
+        if im.width > width:
+            im = im.resize((width, round(im.height * width / im.width)), Image.LANCZOS)
+        out = io.BytesIO()
+        im.save(out, 'WEBP', quality=quality, method=6)
+        return out.getvalue(), '.webp'
+
+
+@lru_cache(maxsize=None)
+def build_asset(name):
+    # Build (once per process, and only if missing on disk) the downscaled variant of
+    # static/img/<name>. The file name is a hash of the source and the encoding
+    # settings, so its URL changes whenever the image does and can be cached forever.
+    path = os.path.join(SOURCE_DIR, name)
+    width, quality = _variant_params(name)
+    with open(path, 'rb') as f:
+        digest = hashlib.sha256(f.read() + f'{width}:{quality}:{Image is not None}'.encode()).hexdigest()[:16]
+
+    with _build_lock:
+        for ext in ('.webp', os.path.splitext(name)[1]):
+            target = os.path.join(CACHE_DIR, digest + ext)
+            if os.path.exists(target):
+                return target
+
+        data, ext = _encode(path, width, quality)
+        target = os.path.join(CACHE_DIR, digest + ext)
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=CACHE_DIR)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, target)
+        return target
+
+
+def build_all():
+    # Pre-build every variant, e.g. before a game night
+    return {name: build_asset(name) for name in sorted(os.listdir(SOURCE_DIR)) if name.endswith('.png')}
+
+
+@lru_cache(maxsize=None)
+def data_uri(name):
+    # Fallback for servers without static serving: encoded once per process, not per rerun
+    target = build_asset(name)
+    mime = 'image/webp' if target.endswith('.webp') else 'image/png'
+    with open(target, 'rb') as f:
+        return f'data:{mime};base64,' + base64.b64encode(f.read()).decode()
+
+
+def asset_url(name, static_serving=True):
+    if not static_serving:
+        return data_uri(name)
+    return STATIC_URL + os.path.basename(build_asset(name))
+
+
+if __name__ == "__main__":
+    for name, target in build_all().items():
+        print(f'{name}: {os.path.getsize(os.path.join(SOURCE_DIR, name)):>9,} -> {os.path.getsize(target):>7,}  {target}')
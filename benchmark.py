@@ -0,0 +1,372 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import pickle
+import civ_core.catalog
+from civ_core import state_manager
+from civ_core.storage import decode_state, encode_state
+from civ_core.catalog import load_catalog, tier_rows, COLUMNS, SCORE_COLUMNS, WEIGHT_COLUMN
+from civ_core.random_generator import (make_decks, random_distribution, find_odds, event_frame, player_seating,
+                                      AliasTable, Deck, HAND_DECKS)
+
+BASELINE_FILE = 'benchmark_baseline.json'
+# A benchmark regresses when its median is this much slower than the baseline median,
+# and by more than REGRESSION_FLOOR_MS (sub-0.05 ms timings are mostly noise)
+REGRESSION_THRESHOLD = 0.25
+REGRESSION_FLOOR_MS = 0.05
+
+SIZES = [10_000, 100_000, 1_000_000]
+PLAYERS = [2, 8, 32]
+REAL_PLAYERS = [2, 4, 8]
+BACKENDS = ['pickle', 'sqlite']
+
+# Each benchmark runs for at least MIN_TIME seconds and MIN_RUNS runs, at most MAX_RUNS
+MIN_TIME = 0.2
+MIN_RUNS = 3
+MAX_RUNS = 200
+
+
+def measure(fn, setup=None, min_time=MIN_TIME, min_runs=MIN_RUNS, max_runs=MAX_RUNS):
+    # Times single calls of fn(); setup() runs untimed before each call
+    times = []
+    started = time.perf_counter()
+    while len(times) < max_runs and (len(times) < min_runs or time.perf_counter() - started < min_time):
+        if setup is not None:
+            setup()
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+
+    times = np.array(times) * 1000
+    return {
+        'runs': len(times),
+        'median_ms': float(np.median(times)),
+        'p95_ms': float(np.percentile(times, 95)),
+        'min_ms': float(times.min()),
+    }
+
+
+def synthetic_catalog(size, seed=0):
+    # `size` bonuses with the tier mix and per-tier score values of the real workbook
+    real = load_catalog()
+    rng = np.random.default_rng(seed)
+
+    tiers, counts = np.unique(real['tier'].to_numpy(), return_counts=True)
+    tier = rng.choice(tiers, size=size, p=counts / counts.sum())
+    scores = np.empty((size, len(SCORE_COLUMNS)))
+    for k in tiers:
+        rows = np.flatnonzero(tier == k)
+        source = real.iloc[tier_rows(real, k)][SCORE_COLUMNS].to_numpy(dtype=np.float64)
+        scores[rows] = source[rng.integers(len(source), size=len(rows))]
+
+    df = pd.DataFrame(scores, columns=SCORE_COLUMNS)
+    df.insert(0, 'bonus', [f'Synthetic bonus {i}' for i in range(size)])
+    df.insert(0, 'tier', tier)
+
+    return df[COLUMNS]
+
+
+def _use_dir(directory):
+    state_manager.STATE_FILE = os.path.join(directory, 'game_state.pkl')
+    state_manager.STATE_DB = os.path.join(directory, 'game_state.db')
+    state_manager.PLAYER_NAMES_FILE = os.path.join(directory, 'player_names.json')
+
+
+def _rerolls_left(decks):
+    # Every reroll takes one card from each deck drawn without replacement
+    return min(len(decks[name]) for name in HAND_DECKS if not decks[name].replace)
+
+
+def bench_import(runs=5):
+    # Cold import of the engine in a fresh interpreter, minus the bare interpreter start
+    def start(code):
+        times = []
+        for _ in range(runs):
+            t0 = time.perf_counter()
+            subprocess.run([sys.executable, '-c', code], check=True)
+            times.append(time.perf_counter() - t0)
+        return np.array(times) * 1000
+
+    bare = np.median(start('pass'))
+    engine = start('import civ_core.state_manager, civ_core.random_generator, civ_core.catalog') - bare
+    return [('import_core', {
+        'runs': runs,
+        'median_ms': float(np.median(engine)),
+        'p95_ms': float(np.percentile(engine, 95)),
+        'min_ms': float(engine.min()),
+    })]
+
+
+def bench_catalog():
+    # The workbook path of the page: parse_sheet() from memory, from the compiled cache, and a full rebuild
+    from web_page import parse_sheet
+
+    # parse_sheet() runs outside `streamlit run` here
+    for logger in ('streamlit.runtime.scriptrunner_utils.script_run_context', 'streamlit.runtime.state.session_state_proxy'):
+        logging.getLogger(logger).setLevel(logging.ERROR)
+
+    def forget():
+        civ_core.catalog._catalog['key'] = None
+
+    def drop_cache():
+        forget()
+        if os.path.exists(civ_core.catalog.CACHE_FILE):
+            os.remove(civ_core.catalog.CACHE_FILE)
+
+    return [
+        ('parse_sheet', measure(parse_sheet)),
+        ('parse_sheet_from_cache', measure(parse_sheet, setup=forget)),
+        ('parse_sheet_rebuild', measure(parse_sheet, setup=drop_cache)),
+    ]
+
+
+def bench_ingest(catalog):
+    # Community packs of this size as CSV, Parquet and a directory of four CSV packs: a cold
+    # compile (chunked read and tier index) and a load from the compiled cache. `bytes` is
+    # the loaded catalog in memory, `peak_bytes` the most Python and numpy held during the
+    # compile (tracemalloc does not see pyarrow's own buffers).
+    try:
+        import pyarrow  # noqa: F401 - Parquet packs are optional
+        kinds = ['csv', 'parquet', 'packs']
+    except ImportError:
+        kinds = ['csv', 'packs']
+    runs = 1 if len(catalog) >= 1_000_000 else MIN_RUNS
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for kind in kinds:
+            source = os.path.join(directory, 'packs' if kind == 'packs' else f'pack.{kind}')
+            if kind == 'packs':
+                os.mkdir(source)
+                for i, part in enumerate(np.array_split(np.arange(len(catalog)), 4)):
+                    catalog.iloc[part].to_csv(os.path.join(source, f'{i}.csv'), index=False)
+            elif kind == 'csv':
+                catalog.to_csv(source, index=False)
+            else:
+                catalog.to_parquet(source, index=False)
+            cache_file = os.path.join(directory, f'{kind}.cache.npz')
+
+            def compile_cold():
+                civ_core.catalog.compile_catalog(source, cache_file)
+
+            tracemalloc.start()
+            compile_cold()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            def forget():
+                civ_core.catalog._catalog['key'] = None
+
+            loaded = load_catalog(source, cache_file)
+            size = int(loaded.memory_usage(deep=True).sum())
+            results.append((f'catalog_compile[{kind}]', {**measure(compile_cold, min_runs=runs, max_runs=max(runs, 3)),
+                                                          'bytes': size, 'peak_bytes': peak}))
+            results.append((f'catalog_load[{kind}]', {**measure(lambda: load_catalog(source, cache_file), setup=forget),
+                                                       'bytes': size}))
+    forget()
+    return results
+
+
+def bench_weights(catalog):
+    # Rarity-weighted decks: the shuffle and the alias table are built once per game (and
+    # grow with the tier), a draw must cost the same at any size
+    catalog = catalog.assign(**{WEIGHT_COLUMN: np.random.default_rng(0).pareto(1.5, len(catalog))})
+    rng = np.random.default_rng(1)
+    technology = Deck(catalog, 4, replace=True)
+    decks = [Deck(catalog, 1, rng=rng)]
+
+    def draw():
+        if len(decks[0]) < 1:
+            decks[0] = Deck(catalog, 1, rng=rng)
+        decks[0].draw()
+        technology.draw(rng)
+
+    return [
+        ('weighted_shuffle', measure(lambda: Deck(catalog, 1, rng=rng))),
+        ('alias_build', measure(lambda: AliasTable(technology.weights()))),
+        ('weighted_draw', measure(draw)),
+    ]
+
+
+def bench_codec(catalog, players):
+    # The compact state payload against pickling the state as it was before it: every
+    # table, the event and the seating plan as DataFrames
+    names = [f'P{i}' for i in range(players)]
+    state = state_manager.build_state(names, seed=0, catalog=catalog)
+    old = dict(state, tables={i: state['tables'][i] for i in state['tables']},
+               random_event=event_frame(catalog, state['random_event']),
+               game_info=dict(state['game_info'], seating=player_seating(state['players'])))
+
+    encoded = encode_state(state)
+    pickled = pickle.dumps(old, protocol=pickle.HIGHEST_PROTOCOL)
+    return [
+        ('state_encode[compact]', {**measure(lambda: encode_state(state)), 'bytes': len(encoded)}),
+        ('state_decode[compact]', {**measure(lambda: decode_state(encoded, catalog)), 'bytes': len(encoded)}),
+        ('state_encode[pickle]', {**measure(lambda: pickle.dumps(old, protocol=pickle.HIGHEST_PROTOCOL)), 'bytes': len(pickled)}),
+        ('state_decode[pickle]', {**measure(lambda: pickle.loads(pickled)), 'bytes': len(pickled)}),
+    ]
+
+
+def bench_game(catalog, players, backends=BACKENDS):
+    names = [f'P{i}' for i in range(players)]
+    results = []
+
+    # Pure generator hot paths
+    decks = make_decks(catalog)
+
+    def refill():
+        if _rerolls_left(decks) < 1:
+            decks.update(make_decks(catalog))
+
+    results.append(('random_distribution',
+                    measure(lambda: random_distribution(*[decks[name] for name in HAND_DECKS]), setup=refill)))
+
+    fresh = make_decks(catalog)
+    tables = [random_distribution(*[fresh[name] for name in HAND_DECKS]) for _ in range(players)]
+    results.append(('find_odds', measure(lambda: find_odds(tables, names))))
+
+    # The same operations through the state store
+    for backend in backends:
+        state_manager.STATE_BACKEND = backend
+        with tempfile.TemporaryDirectory() as directory:
+            _use_dir(directory)
+            # Saved decks store rows only; bind them to this catalog, not the workbook's
+            state_manager.get_backend().catalog = catalog
+            results.append((f'initialize_state[{backend}]',
+                            measure(lambda: state_manager.initialize_state(names, catalog=catalog))))
+
+            left = [0]
+
+            def deal():
+                if left[0] < 1:
+                    state = state_manager.initialize_state(names, catalog=catalog)
+                    left[0] = _rerolls_left(state['decks'])
+                left[0] -= 1
+
+            results.append((f'reroll_player[{backend}]', measure(lambda: state_manager.reroll_player(0), setup=deal)))
+
+            state = state_manager.load_state()
+            key = (backend, state_manager._path(state_manager.DEFAULT_ROOM))
+            results.append((f'load_state[{backend}]', measure(state_manager.load_state)))
+            results.append((f'load_state_cold[{backend}]',
+                            measure(state_manager.load_state, setup=lambda: state_manager._cache.discard(key))))
+            results.append((f'save_state[{backend}]', measure(lambda: state_manager.save_state(state))))
+            # What a page run pays for the odds tables once the version has been seen
+            results.append((f'game_odds[{backend}]', measure(lambda: state_manager.game_odds(state))))
+            # Unwritten commits go to this directory before it is removed
+            state_manager.flush()
+
+    return results
+
+
+def run(sizes=SIZES, players=PLAYERS, real_players=REAL_PLAYERS, backends=BACKENDS, only=None):
+    cases = [('real', None, p) for p in real_players]
+    cases += [(f'synthetic-{size}', size, p) for size in sizes for p in players]
+
+    results = []
+
+    def add(case, rows, count, items):
+        for name, timing in items:
+            if only and name.split('[')[0] not in only:
+                continue
+            results.append({'name': name, 'case': case, 'rows': rows, 'players': count, **timing})
+            size = f"  {timing['bytes']} bytes" if 'bytes' in timing else ''
+            size += f" (peak {timing['peak_bytes']})" if 'peak_bytes' in timing else ''
+            print(f"{name:<32} {case:<18} {count or '-':>3} players  median {timing['median_ms']:>10.3f} ms"
+                  f"  p95 {timing['p95_ms']:>10.3f} ms  ({timing['runs']} runs){size}")
+
+    if not only or 'import_core' in only:
+        add('real', None, None, bench_import())
+    if not only or 'parse_sheet' in only:
+        add('real', len(load_catalog()), None, bench_catalog())
+
+    if not only or {'catalog_compile', 'catalog_load'} & set(only):
+        for size in sizes:
+            add(f'synthetic-{size}', size, None, bench_ingest(synthetic_catalog(size)))
+    if not only or {'weighted_shuffle', 'alias_build', 'weighted_draw'} & set(only):
+        for size in sizes:
+            add(f'synthetic-{size}', size, None, bench_weights(synthetic_catalog(size)))
+
+    for case, size, count in cases:
+        catalog = load_catalog() if size is None else synthetic_catalog(size)
+        if count > min(len(tier_rows(catalog, tier)) for tier in (1, 2, 3, 5)):
+            print(f'skipping {case} with {count} players: not enough cards')
+            continue
+        add(case, len(catalog), count, bench_codec(catalog, count) + bench_game(catalog, count, backends))
+
+    return {
+        'meta': {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+        },
+        'results': results,
+    }
+
+
+def _key(result):
+    return result['name'], result['case'], result['players']
+
+
+def compare(report, baseline, threshold=REGRESSION_THRESHOLD, floor_ms=REGRESSION_FLOOR_MS):
+    # Benchmarks whose median got slower than the baseline by more than the threshold
+    old = {_key(r): r for r in baseline['results']}
+    regressions = []
+    for result in report['results']:
+        before = old.get(_key(result))
+        if before is None:
+            continue
+        now, then = result['median_ms'], before['median_ms']
+        if now > then * (1 + threshold) and now - then > floor_ms:
+            regressions.append({**result, 'baseline_ms': then, 'ratio': now / then})
+
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks for the generator and game state hot paths')
+    parser.add_argument('--sizes', type=int, nargs='*', default=SIZES, help='synthetic catalog sizes')
+    parser.add_argument('--players', type=int, nargs='+', default=PLAYERS)
+    parser.add_argument('--backends', nargs='+', default=BACKENDS, choices=BACKENDS)
+    parser.add_argument('--only', nargs='+', default=None, help='run only these benchmarks')
+    parser.add_argument('--quick', action='store_true', help='real workbook and 10k bonuses only')
+    parser.add_argument('--json', default=None, help='write the results to this file')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='compare against this file if it exists')
+    parser.add_argument('--save-baseline', action='store_true', help='store these results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD)
+    args = parser.parse_args()
+
+    sizes = [10_000] if args.quick else args.sizes
+    report = run(sizes, args.players, REAL_PLAYERS, args.backends, args.only)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+    regressions = []
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        for r in regressions:
+            print(f"REGRESSION {r['name']} {r['case']} {r['players']} players: "
+                  f"{r['baseline_ms']:.3f} -> {r['median_ms']:.3f} ms ({r['ratio']:.2f}x)")
+        print(f'{len(regressions)} regressions against {args.baseline}')
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f'baseline saved to {args.baseline}')
+
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,2 @@
+# Game engine without any UI code: catalog, decks and deals, odds, game state and its storage.
+# pandas (and openpyxl through it) is only imported when a function needs it.
@@ -0,0 +1,313 @@
+import hashlib
+import itertools
+import os
+import tempfile
+import weakref
+import numpy as np
+from .metrics import timed
+
+FILE_NAME = 'Civ_bonuses.xlsx'
+SHEET_NAME = 'Sheet1'
+CACHE_FILE = 'Civ_bonuses.cache.npz'
+CACHE_VERSION = 3
+
+# Where the bonuses come from: the workbook, a .csv or .parquet pack, or a directory of packs
+# (every .xlsx/.csv/.parquet file in it, appended in file name order). Packs have the
+# workbook's six columns in the same order, under a header row, and optionally a seventh:
+# the card's draw weight (rarity). Blank weights count as 1; a weight of 0 is never dealt.
+CATALOG = os.environ.get('CIV_CATALOG', FILE_NAME)
+PACK_TYPES = ('.xlsx', '.csv', '.parquet')
+# Packs are read this many rows at a time
+CHUNK_ROWS = 50_000
+
+COLUMNS = ['tier', 'bonus', 'cul', 'eco', 'war', 'tech']
+SCORE_COLUMNS = ['cul', 'eco', 'war', 'tech']
+# Only catalogs with a weight other than 1 have this column
+WEIGHT_COLUMN = 'weight'
+
+# Process-wide copy of the last catalog we loaded, keyed by its source and mtime
+_catalog = {'key': None, 'df': None}
+# id(catalog) -> (weak reference, tier index) of the catalogs in use, see tier_index()
+_indexes = {}
+
+
+def file_digest(file_name):
+    h = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def pack_files(source):
+    # The files a source is read from, in order
+    if not os.path.isdir(source):
+        return [source]
+    names = sorted(name for name in os.listdir(source) if name.lower().endswith(PACK_TYPES))
+    return [os.path.join(source, name) for name in names]
+
+
+def source_mtime(source):
+    # Adding or removing a pack touches the directory; editing one touches the file
+    files = pack_files(source)
+    return max([os.path.getmtime(source)] + [os.path.getmtime(path) for path in files])
+
+
+def source_digest(source):
+    if not os.path.isdir(source):
+        return file_digest(source)
+    h = hashlib.sha256()
+    for path in pack_files(source):
+        h.update(f'{os.path.basename(path)}:{file_digest(path)};'.encode('utf-8'))
+    return h.hexdigest()
+
+
+def _cache_path(source):
+    # The workbook keeps its cache name; packs get theirs next to them
+    return CACHE_FILE if source == FILE_NAME else source.rstrip('/\\') + '.cache.npz'
+
+
+def _xlsx_chunks(path):
+    # openpyxl's read-only mode streams the sheet instead of loading the whole workbook
+    import openpyxl
+    import pandas as pd
+    book = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        sheet = book[SHEET_NAME] if SHEET_NAME in book.sheetnames else book.worksheets[0]
+        rows = sheet.iter_rows(min_row=2, max_col=len(COLUMNS) + 1, values_only=True)
+        rows = (row for row in rows if any(value is not None for value in row))
+        while True:
+            chunk = list(itertools.islice(rows, CHUNK_ROWS))
+            if not chunk:
+                break
+            yield _named(pd.DataFrame(chunk))
+    finally:
+        book.close()
+
+
+def _named(df):
+    # The pack's columns by position: the six catalog columns and the weight, if there is one
+    df = df.iloc[:, :len(COLUMNS) + 1]
+    return df.set_axis((COLUMNS + [WEIGHT_COLUMN])[:df.shape[1]], axis=1)
+
+
+def _csv_chunks(path):
+    import pandas as pd
+    for chunk in pd.read_csv(path, header=0, encoding='utf-8-sig', chunksize=CHUNK_ROWS):
+        yield _named(chunk)
+
+
+def _parquet_chunks(path):
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError(f'reading {path} needs pyarrow (pip install pyarrow)') from None
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=CHUNK_ROWS):
+        yield _named(batch.to_pandas())
+
+
+READERS = {'.xlsx': _xlsx_chunks, '.csv': _csv_chunks, '.parquet': _parquet_chunks}
+
+
+def _chunk_arrays(df, path, start):
+    # One chunk as (tier, bonus texts, scores, weights); `start` is the chunk's first data row in the file
+    import pandas as pd
+
+    def numbers(name, blank=0, rule='number'):
+        values = pd.to_numeric(df[name], errors='coerce')
+        bad = values.isna() & df[name].notna()
+        if name == 'tier':
+            bad |= values.isna() | (values < 0) | (values != values.round())
+        elif name == WEIGHT_COLUMN:
+            bad |= (values < 0) | np.isinf(values)
+        if bad.any():
+            row = start + int(np.flatnonzero(bad.to_numpy())[0]) + 2
+            raise ValueError(f'{path}, row {row}: {name} must be a {rule}')
+        return values.fillna(blank).to_numpy(dtype=np.float64)
+
+    tier = numbers('tier', rule='whole number >= 0').astype(np.int64)
+    scores = np.column_stack([numbers(name) for name in SCORE_COLUMNS])
+    bonus = df['bonus'].fillna('').astype(str).tolist()
+    if WEIGHT_COLUMN in df:
+        weight = numbers(WEIGHT_COLUMN, blank=1, rule='finite number >= 0')
+    else:
+        weight = np.ones(len(df))
+    return tier, bonus, scores, weight
+
+
+def build_tier_index(tier):
+    # (order, offsets) with one counting pass over the tiers: order lists the rows grouped by
+    # tier (catalog order within a tier) and offsets[k] is where tier k starts in it. Tiers
+    # fit a byte, for which numpy's stable sort is a linear radix sort.
+    tier = np.asarray(tier, dtype=np.int64)
+    if len(tier) and tier.max() < 256:
+        tier = tier.astype(np.uint8)
+    counts = np.bincount(tier, minlength=1)
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    order = np.argsort(tier, kind='stable').astype(np.int64)
+    return order, offsets
+
+
+def _attach(catalog, index):
+    key = id(catalog)
+    _indexes[key] = (weakref.ref(catalog), index)
+    weakref.finalize(catalog, _indexes.pop, key, None)
+    return catalog
+
+
+def tier_index(catalog):
+    # The tier index of a catalog: compiled catalogs bring theirs from the cache, others
+    # (synthetic, test) are indexed the first time they are asked for it. Catalogs are never
+    # changed in place, so the index lives as long as the catalog.
+    entry = _indexes.get(id(catalog))
+    if entry is not None and entry[0]() is catalog:
+        return entry[1]
+    index = build_tier_index(catalog['tier'].to_numpy())
+    _attach(catalog, index)
+    return index
+
+
+def tier_rows(catalog, tier):
+    # Row positions of one tier, in catalog order
+    order, offsets = tier_index(catalog)
+    if not 0 <= tier < len(offsets) - 1:
+        return order[:0]
+    return order[offsets[tier]:offsets[tier + 1]]
+
+
+@timed('catalog.compile')
+def compile_catalog(source=None, cache_file=None, digest=None):
+    # Reads the source chunk by chunk into the compact cache arrays. Bonus texts are kept as
+    # one UTF-8 blob plus byte end offsets, not as a fixed-width array as long as the longest text.
+    source = CATALOG if source is None else source
+    cache_file = _cache_path(source) if cache_file is None else cache_file
+    tiers, scores, texts, lengths, weights = [], [], [], [], []
+    for path in pack_files(source):
+        read = READERS.get(os.path.splitext(path)[1].lower())
+        if read is None:
+            raise ValueError(f'{path}: catalogs are read from {", ".join(PACK_TYPES)} files')
+        start = 0
+        for chunk in read(path):
+            tier, bonus, score, weight = _chunk_arrays(chunk, path, start)
+            start += len(chunk)
+            tiers.append(tier)
+            scores.append(score)
+            weights.append(weight)
+            encoded = [text.encode('utf-8') for text in bonus]
+            texts.append(b''.join(encoded))
+            lengths.append(np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)))
+
+    tier = np.concatenate(tiers) if tiers else np.empty(0, dtype=np.int64)
+    order, offsets = build_tier_index(tier)
+    data = {
+        'version': np.int64(CACHE_VERSION),
+        'mtime': np.float64(source_mtime(source)),
+        'digest': np.str_(digest or source_digest(source)),
+        'index': np.arange(len(tier), dtype=np.int64),
+        'tier': tier,
+        'bonus_text': np.frombuffer(b''.join(texts), dtype=np.uint8),
+        'bonus_ends': np.cumsum(np.concatenate(lengths)) if lengths else np.empty(0, dtype=np.int64),
+        'scores': np.concatenate(scores) if scores else np.empty((0, len(SCORE_COLUMNS))),
+        'tier_order': order,
+        'tier_offsets': offsets,
+    }
+    weight = np.concatenate(weights) if weights else np.empty(0)
+    if (weight != 1).any():
+        data['weight'] = weight
+    _write_cache(cache_file, **data)
+
+    return data
+
+
+def _write_cache(cache_file, **arrays):
+    # Unique temp name per writer: several sessions may rebuild the cache at the same time
+    directory = os.path.dirname(os.path.abspath(cache_file))
+    fd, tmp_file = tempfile.mkstemp(prefix='.catalog.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_file, cache_file)
+    except BaseException:
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+        raise
+
+
+def _read_cache(cache_file):
+    with np.load(cache_file, allow_pickle=False) as data:
+        if int(data['version']) != CACHE_VERSION:
+            return None
+        return {key: data[key] for key in data.files}
+
+
+def _bonus_column(blob, ends):
+    import pandas as pd
+    offsets = np.concatenate([[0], ends]).astype(np.int64)
+    if pd.Series(['']).dtype != object:
+        # This pandas keeps strings in Arrow: wrap the cached buffers instead of creating a
+        # Python string per bonus (half a second at a million bonuses)
+        try:
+            import pyarrow as pa
+            return pd.array(pa.LargeStringArray.from_buffers(len(ends), pa.py_buffer(offsets), pa.py_buffer(blob)),
+                            dtype='str')
+        except ImportError:
+            pass
+    data = blob.tobytes()
+    bounds = offsets.tolist()
+    return np.array([data[start:end].decode('utf-8') for start, end in zip(bounds[:-1], bounds[1:])], dtype=object)
+
+
+def _frame_from_cache(data):
+    import pandas as pd
+    df = pd.DataFrame(data['scores'], index=data['index'], columns=SCORE_COLUMNS)
+    df.insert(0, 'bonus', _bonus_column(data['bonus_text'], data['bonus_ends']))
+    df.insert(0, 'tier', data['tier'])
+    if 'weight' in data:
+        df[WEIGHT_COLUMN] = data['weight']
+
+    return _attach(df, (data['tier_order'], data['tier_offsets']))
+
+
+def _copy(df):
+    # Callers get their own frame; the index arrays are shared
+    return _attach(df.copy(), tier_index(df))
+
+
+@timed('catalog.load')
+def load_catalog(file_name=None, cache_file=None):
+    source = CATALOG if file_name is None else file_name
+    cache_file = _cache_path(source) if cache_file is None else cache_file
+    mtime = source_mtime(source)
+    if _catalog['key'] == (source, mtime):
+        return _copy(_catalog['df'])
+
+    data = None
+    try:
+        data = _read_cache(cache_file)
+    except (OSError, ValueError, KeyError):
+        data = None
+
+    if data is None or float(data['mtime']) != mtime:
+        # mtime moved (or no cache yet) - only rebuild if the content really changed
+        digest = source_digest(source)
+        if data is not None and str(data['digest']) == digest:
+            data['mtime'] = np.float64(mtime)
+            try:
+                _write_cache(cache_file, **data)
+            except OSError:
+                pass
+        else:
+            data = compile_catalog(source, cache_file, digest)
+    df = _frame_from_cache(data)
+
+    _catalog['key'] = (source, mtime)
+    _catalog['df'] = df
+
+    return _copy(df)
+
+
+def split_tiers(df):
+    return [df.iloc[tier_rows(df, k)] for k in range(1, 7)]
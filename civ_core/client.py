@@ -0,0 +1,68 @@
+import http.client
+import json
+import threading
+from urllib.parse import urlsplit
+from .rooms import DEFAULT_ROOM
+from .storage import decode_state
+
+
+class ApiError(Exception):
+    pass
+
+
+class ApiClient:
+    # Blocking client for civ_core.server, with one keep-alive connection per thread
+
+    def __init__(self, url, timeout=10):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _request(self, method, path, body=None):
+        # A kept-alive connection the server has dropped is reopened once
+        for attempt in range(2):
+            conn = getattr(self._local, 'conn', None)
+            if conn is None:
+                conn = self._local.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                conn.request(method, path, body=body, headers={'Content-Type': 'application/json'})
+                response = conn.getresponse()
+                return response, response.read()
+            except (http.client.HTTPException, ConnectionError):
+                conn.close()
+                self._local.conn = None
+                if attempt:
+                    raise
+
+    def _json(self, method, path, body=None):
+        response, data = self._request(method, path, body)
+        if response.status == 404:
+            return None
+        payload = json.loads(data)
+        if response.status != 200:
+            raise ApiError(payload.get('error', f'HTTP {response.status}'))
+        return payload
+
+    def call(self, op, room=DEFAULT_ROOM, **args):
+        # {'changed': ..., 'state': <summary>}, or None when the room has no game
+        return self._json('POST', f'/rooms/{room}/{op}', json.dumps(args).encode('utf-8'))
+
+    def summary(self, room=DEFAULT_ROOM):
+        return self._json('GET', f'/rooms/{room}')
+
+    def version(self, room=DEFAULT_ROOM):
+        # The version of the room's game on the server, None when there is none
+        return self._json('GET', f'/rooms/{room}/version')['version']
+
+    def load_state(self, room=DEFAULT_ROOM):
+        # The full game, as state_manager.load_state() would return it; None when there is none
+        response, data = self._request('GET', f'/rooms/{room}/state')
+        if response.status == 404:
+            return None
+        if response.status != 200:
+            raise ApiError(json.loads(data).get('error', f'HTTP {response.status}'))
+        state = decode_state(data)
+        state['version'] = int(response.getheader('X-Civ-Version'))
+        return state
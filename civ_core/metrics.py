@@ -0,0 +1,224 @@
+import argparse
+import bisect
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+# Off unless configured: CIV_METRICS_PORT serves /metrics (Prometheus text) and /metrics.json
+# on 127.0.0.1, CIV_METRICS_LOG appends a JSON snapshot every LOG_INTERVAL seconds
+METRICS_PORT = os.environ.get('CIV_METRICS_PORT')
+METRICS_LOG = os.environ.get('CIV_METRICS_LOG')
+LOG_INTERVAL = 10.0
+
+# Histogram bucket upper bounds in seconds, from sub-millisecond cache hits to slow disk writes
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Rerun counts are kept for this many most recent sessions
+MAX_SESSIONS = 256
+
+
+class Histogram:
+
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation (inf past the last bound)
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Metrics:
+    # Process-wide span histograms and rerun counters. Recording a span costs two clock
+    # reads and a short lock, so spans can stay on in production.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._spans = {}
+        self._sessions = OrderedDict()
+        self._reruns = 0
+        self._started = set()
+
+    def observe(self, name, seconds):
+        with self._lock:
+            histogram = self._spans.get(name)
+            if histogram is None:
+                histogram = self._spans[name] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def timed(self, name):
+        def decorate(fn):
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - start)
+            return wrapper
+        return decorate
+
+    def rerun(self, session_id):
+        with self._lock:
+            self._reruns += 1
+            self._sessions[session_id] = self._sessions.pop(session_id, 0) + 1
+            while len(self._sessions) > MAX_SESSIONS:
+                self._sessions.popitem(last=False)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'time': time.time(),
+                'spans': {
+                    name: {'count': h.count, 'sum': h.sum, 'buckets': list(h.counts)}
+                    for name, h in sorted(self._spans.items())
+                },
+                'bounds': list(BUCKETS),
+                'reruns': self._reruns,
+                'session_reruns': dict(self._sessions),
+            }
+
+    def prometheus(self):
+        snap = self.snapshot()
+        lines = [
+            '# HELP civ_span_seconds Time spent in instrumented operations.',
+            '# TYPE civ_span_seconds histogram',
+        ]
+        for name, span in snap['spans'].items():
+            cumulative = 0
+            for bound, count in zip(snap['bounds'] + ['+Inf'], span['buckets']):
+                cumulative += count
+                lines.append(f'civ_span_seconds_bucket{{span="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'civ_span_seconds_sum{{span="{name}"}} {span["sum"]}')
+            lines.append(f'civ_span_seconds_count{{span="{name}"}} {span["count"]}')
+
+        lines += [
+            '# HELP civ_reruns_total Page script runs.',
+            '# TYPE civ_reruns_total counter',
+            f'civ_reruns_total {snap["reruns"]}',
+            '# HELP civ_session_reruns_total Page script runs per browser session.',
+            '# TYPE civ_session_reruns_total counter',
+        ]
+        lines += [f'civ_session_reruns_total{{session="{session}"}} {count}'
+                  for session, count in snap['session_reruns'].items()]
+
+        return '\n'.join(lines) + '\n'
+
+    def start(self, port=None, log_path=None, interval=LOG_INTERVAL):
+        # Start the configured exporters once per process; both default to the environment
+        port = METRICS_PORT if port is None else port
+        log_path = METRICS_LOG if log_path is None else log_path
+        with self._lock:
+            todo = {'port': port, 'log': log_path}
+            todo = {kind: value for kind, value in todo.items() if value and kind not in self._started}
+            self._started.update(todo)
+
+        if 'port' in todo:
+            from http.server import ThreadingHTTPServer
+            try:
+                server = ThreadingHTTPServer(('127.0.0.1', int(todo['port'])), _handler(self))
+            except OSError:
+                # Port taken (e.g. a second server on this machine): keep collecting, just don't serve
+                server = None
+            if server is not None:
+                threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+        if 'log' in todo:
+            threading.Thread(target=self._log, args=(todo['log'], interval), name='metrics-log', daemon=True).start()
+
+    def _log(self, path, interval):
+        last = None
+        stop = threading.Event()
+        while not stop.wait(interval):
+            snap = self.snapshot()
+            marker = (snap['reruns'], sum(span['count'] for span in snap['spans'].values()))
+            if marker == last:
+                continue
+            last = marker
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(snap) + '\n')
+
+
+def _handler(metrics):
+    from http.server import BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                body, kind = metrics.prometheus().encode(), 'text/plain; version=0.0.4'
+            elif self.path == '/metrics.json':
+                body, kind = json.dumps(metrics.snapshot()).encode(), 'application/json'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', kind)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return MetricsHandler
+
+
+def summarize(snap):
+    # Rows of (span, count, total s, mean ms, ~p50 ms, ~p95 ms), slowest total first
+    rows = []
+    for name, span in snap['spans'].items():
+        h = Histogram(tuple(snap['bounds']))
+        h.counts, h.sum, h.count = span['buckets'], span['sum'], span['count']
+        rows.append((name, h.count, h.sum, h.sum / max(h.count, 1) * 1000, h.quantile(0.5) * 1000, h.quantile(0.95) * 1000))
+
+    return sorted(rows, key=lambda row: -row[2])
+
+
+metrics = Metrics()
+span = metrics.span
+timed = metrics.timed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Summarize the timing metrics of a running app')
+    parser.add_argument('source', help='a JSONL log written via CIV_METRICS_LOG, or http://127.0.0.1:<port>')
+    args = parser.parse_args()
+
+    if args.source.startswith('http'):
+        from urllib.request import urlopen
+        with urlopen(args.source.rstrip('/') + '/metrics.json') as response:
+            snap = json.load(response)
+    else:
+        with open(args.source, encoding='utf-8') as f:
+            snap = json.loads(f.readlines()[-1])
+
+    print(f"{'span':<34} {'count':>7} {'total s':>9} {'mean ms':>9} {'~p50 ms':>9} {'~p95 ms':>9}")
+    for name, count, total, mean, p50, p95 in summarize(snap):
+        print(f'{name:<34} {count:>7} {total:>9.3f} {mean:>9.2f} {p50:>9.1f} {p95:>9.1f}')
+    print(f"\nreruns: {snap['reruns']} in {len(snap['session_reruns'])} sessions")
+    for session, count in sorted(snap['session_reruns'].items(), key=lambda item: -item[1])[:10]:
+        print(f'  {session}: {count}')
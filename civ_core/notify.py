@@ -0,0 +1,125 @@
+import os
+import threading
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # optional, fall back to polling the stored versions
+    Observer = None
+    FileSystemEventHandler = object
+
+WATCH_INTERVAL = 1.0
+
+
+class ChangeHub:
+    # Process-wide pub/sub for state versions, one topic per game room. Commits made in
+    # this process publish directly; one watcher thread picks up commits made by other
+    # processes. Subscribers are woken once per new version, so idle sessions cost nothing.
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._versions = {}
+        self._subscribers = {}
+        self._watcher = None
+
+    def version(self, topic):
+        return self._versions.get(topic)
+
+    def topics(self):
+        # Topics somebody is currently waiting on
+        with self._cond:
+            return {topic for topic, key in self._subscribers}
+
+    def publish(self, topic, version):
+        with self._cond:
+            if self._versions.get(topic) == version:
+                return
+            self._versions[topic] = version
+            self._cond.notify_all()
+            due = [(key, wake) for key, (seen, wake) in self._subscribers.items()
+                   if key[0] == topic and seen != version]
+            for key, wake in due:
+                self._subscribers[key] = (version, wake)
+
+        # Wake outside the lock; a subscriber that reports False is gone
+        for key, wake in due:
+            if wake() is False:
+                self.unsubscribe(*key)
+
+    def subscribe(self, topic, key, seen_version, wake):
+        # Replaces any earlier subscription of `key`; wakes at once if a newer version already exists
+        with self._cond:
+            for old in [k for k in self._subscribers if k[1] == key and k[0] != topic]:
+                del self._subscribers[old]
+            current = self._versions.get(topic)
+            missed = current is not None and current != seen_version
+            self._subscribers[(topic, key)] = (current if missed else seen_version, wake)
+        if missed and wake() is False:
+            self.unsubscribe(topic, key)
+
+    def unsubscribe(self, topic, key):
+        with self._cond:
+            self._subscribers.pop((topic, key), None)
+
+    def wait(self, topic, seen_version, timeout=None):
+        # The topic's newer version, or `seen_version` after `timeout`. A topic nothing was
+        # published to yet has not moved.
+        with self._cond:
+            self._cond.wait_for(lambda: self._versions.get(topic, seen_version) != seen_version, timeout)
+            return self._versions.get(topic, seen_version)
+
+    def start_watcher(self, probe, paths=(), interval=WATCH_INTERVAL):
+        # `probe(topic)` returns the stored version of a topic; the watcher re-probes the
+        # subscribed topics whenever something under the directories of `paths` changes
+        # (watchdog installed), or every `interval` seconds otherwise.
+        with self._cond:
+            if self._watcher is not None:
+                return
+            self._watcher = _Watcher(self, probe, paths, interval)
+        self._watcher.start()
+
+
+class _StateFileHandler(FileSystemEventHandler):
+
+    def __init__(self, on_change):
+        self.on_change = on_change
+
+    def on_any_event(self, event):
+        if not event.is_directory:
+            self.on_change()
+
+
+class _Watcher:
+
+    def __init__(self, hub, probe, paths, interval):
+        self.hub = hub
+        self.probe = probe
+        self.directories = {os.path.dirname(os.path.abspath(p)) for p in paths}
+        self.interval = interval
+
+    def check(self):
+        for topic in self.hub.topics():
+            try:
+                self.hub.publish(topic, self.probe(topic))
+            except Exception:
+                pass
+
+    def start(self):
+        if Observer is not None and self.directories:
+            observer = Observer()
+            handler = _StateFileHandler(self.check)
+            for directory in self.directories:
+                os.makedirs(directory, exist_ok=True)
+                observer.schedule(handler, directory, recursive=False)
+            observer.daemon = True
+            observer.start()
+        else:
+            threading.Thread(target=self._poll, name='state-watcher', daemon=True).start()
+
+    def _poll(self):
+        stop = threading.Event()
+        while not stop.wait(self.interval):
+            self.check()
+
+
+hub = ChangeHub()
@@ -0,0 +1,762 @@
+import numpy as np
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from .catalog import tier_index, tier_rows, WEIGHT_COLUMN
+
+_rng = np.random.default_rng()
+# (catalog, its score columns) for score_matrix()
+_scores = [None, None]
+# (tier index, pool, distinct score vectors, codes) of the decks of the last few games, by
+# (game, tier); see Deck.tally()
+_codes = OrderedDict()
+TALLY_CACHE_SIZE = 40
+
+
+def _workbook():
+    from .catalog import load_catalog
+    return load_catalog()
+
+CATEGORIES = ['cul', 'eco', 'war', 'tech']
+VICTORY_TYPES = ['Культура', 'Экономика', 'Война', 'Технологии']
+WIN_TYPES = ['Культурная', 'Экономическая', 'Военная', 'Технологическая']
+WIN_WEIGHTS = np.array([1.1, 1.05, 0.95, 1.05])
+
+
+def catalog_weights(catalog):
+    # Draw weights of the catalog rows, or None when every card is equally likely
+    if WEIGHT_COLUMN not in catalog.columns:
+        return None
+    return catalog[WEIGHT_COLUMN].to_numpy(dtype=np.float64)
+
+
+class AliasTable:
+    # Vose's alias method: once the table is built (a few vector passes over the weights),
+    # a draw is one uniform column and one biased coin, the same cost at any deck size.
+
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=np.float64)
+        self.weights = weights
+        # Cards that can be drawn at all
+        self.support = int(np.count_nonzero(weights))
+        n = len(weights)
+        scaled = weights * (n / weights.sum())
+        self.prob = np.ones(n)
+        self.alias = np.arange(n)
+        is_small = scaled < 1
+        # The heaviest column is at least 1, even when rounding puts it a hair below
+        is_small[scaled.argmax()] = False
+        small, large = np.flatnonzero(is_small), np.flatnonzero(~is_small)
+        if not len(small):
+            return
+        # Vose's pairing without the loop: the large columns give away their excess over 1 in
+        # turn and the small ones take what they lack in turn, so a small column's alias is the
+        # first large whose running excess covers the running need before it. A large column
+        # that gave more than its excess lacks the difference, and the next large makes it up.
+        need = np.cumsum(1 - scaled[small])
+        before = np.concatenate([[0.0], need])
+        excess = np.cumsum(scaled[large] - 1)
+        givers = np.minimum(np.searchsorted(excess, before[:-1], side='left'), len(large) - 1)
+        self.prob[small] = scaled[small]
+        self.alias[small] = large[givers]
+        lacking = before[np.searchsorted(before[:-1], excess[:-1], side='right')] - excess[:-1]
+        self.prob[large[:-1]] = np.clip(1 - lacking, 0, 1)
+        self.alias[large[:-1]] = large[1:]
+
+    def __len__(self):
+        return len(self.prob)
+
+    def draw(self, rng=None):
+        rng = _rng if rng is None else rng
+        i = int(rng.integers(len(self.prob)))
+        return i if rng.random() < self.prob[i] else int(self.alias[i])
+
+    def sample(self, rng, size):
+        columns = rng.integers(len(self.prob), size=size)
+        return np.where(rng.random(size) < self.prob[columns], columns, self.alias[columns])
+
+
+def weighted_permutation(rows, weights, rng):
+    # Rows in the order weighted draws without replacement would take them: each row gets an
+    # exponential clock with rate = its weight and rows go in order of their clocks. Whatever
+    # was taken so far, the next row is then drawn with probability proportional to its weight.
+    if weights is None:
+        return rng.permutation(rows)
+    with np.errstate(divide='ignore'):
+        keys = rng.exponential(size=len(rows)) / weights
+    return rows[np.argsort(keys, kind='stable')]
+
+
+class Deck:
+    # A tier of the catalog as catalog row positions, shuffled once when the game is dealt.
+    # The live cards are pool[cursor:], in draw order: a draw takes pool[cursor] and
+    # advances the cursor. Decks drawn with replacement keep the cursor at 0.
+    # Weighted catalogs shuffle with weighted_permutation() and leave out cards weighted 0;
+    # weighted decks drawn with replacement draw from an AliasTable over the pool.
+    # Pickles as tier, pool and cursor only; the catalog is bound again on load.
+
+    def __init__(self, catalog, tier, replace=False, rows=None, rng=None, shuffle=True):
+        self._catalog = catalog
+        self.tier = tier
+        self.replace = replace
+        if rows is None:
+            rows = tier_rows(catalog, tier)
+            weights = catalog_weights(catalog)
+            if weights is not None:
+                rows = rows[weights[rows] > 0]
+        self.pool = np.asarray(rows, dtype=np.int64).copy()
+        self._alias = None
+        if shuffle and not replace:
+            self.pool = weighted_permutation(self.pool, self.weights(), _rng if rng is None else rng)
+        self.cursor = 0
+        self._tally = None
+
+    @classmethod
+    def restore(cls, catalog, tier, replace, pool, cursor=0):
+        # A deck whose pool is already in draw order, e.g. read back from storage
+        deck = cls(catalog, tier, replace, rows=pool, shuffle=False)
+        deck.cursor = cursor
+        return deck
+
+    @property
+    def catalog(self):
+        # Unpickled decks use the workbook's catalog unless a loader bound another one
+        if self._catalog is None:
+            self._catalog = _workbook()
+        return self._catalog
+
+    @catalog.setter
+    def catalog(self, catalog):
+        self._catalog = catalog
+
+    def __getstate__(self):
+        return {'tier': self.tier, 'replace': self.replace, 'pool': _compact(self.pool), 'cursor': self.cursor}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.pool = self.pool.astype(np.int64)
+        self._catalog = state.get('catalog')
+        self._tally = None
+        self._alias = None
+        if 'size' in state:
+            # Saves from before the cursor: live cards were pool[:size], in no particular order
+            del self.__dict__['size']
+            self.__dict__.pop('catalog', None)
+            self.pool = self.pool[:state['size']]
+            if not self.replace:
+                self.pool = _rng.permutation(self.pool)
+            self.cursor = 0
+
+    def __len__(self):
+        return len(self.pool) - self.cursor
+
+    def draw(self, rng=None):
+        if len(self) < 1:
+            return None
+        if self.replace:
+            rng = _rng if rng is None else rng
+            if self._alias is None:
+                # Looked up on the first draw: the alias table of a weighted deck, False otherwise
+                self._alias = AliasTable(self.weights()) if self.weighted() else False
+            if self._alias is not False:
+                return int(self.pool[self._alias.draw(rng)])
+            return int(self.pool[rng.integers(len(self.pool))])
+
+        row = int(self.pool[self.cursor])
+        self._advance()
+        return row
+
+    def take(self, rows, at=None):
+        # Deal specific cards, e.g. the ones a balanced deal picked: each is swapped to the cursor.
+        # Weighted decks move it there instead, keeping the weighted order of the cards behind it.
+        # `at` gives the cards' positions among the live ones, saving a search of the deck per card.
+        if self.replace:
+            return
+        weighted = self.weighted()
+        if at is None:
+            at = [int(np.flatnonzero(self.live() == row)[0]) for row in rows]
+        # Positions of the cards still to take, kept up to date as the cards in front of them move
+        where = {int(row): self.cursor + int(i) for row, i in zip(rows, at)}
+        for row in rows:
+            i = where.pop(int(row))
+            if weighted:
+                where = {other: k + 1 if k < i else k for other, k in where.items()}
+                self._move(i, self.cursor)
+            else:
+                displaced = int(self.pool[self.cursor])
+                if displaced in where:
+                    where[displaced] = i
+                self._swap(i, self.cursor)
+            self._advance()
+
+    def seek(self, cursor):
+        # Put the cursor back (or forward) to an earlier position, e.g. on undo
+        self.cursor = cursor
+        self._tally = None
+
+    def _swap(self, i, j):
+        self.pool[i], self.pool[j] = self.pool[j], self.pool[i]
+        if self._tally is not None:
+            codes = self._tally[2]
+            codes[i], codes[j] = codes[j], codes[i]
+
+    def _move(self, i, j):
+        # Move pool[i] back to j < i, shifting pool[j:i] one place on
+        for array in (self.pool,) if self._tally is None else (self.pool, self._tally[2]):
+            array[j:i + 1] = np.roll(array[j:i + 1], 1)
+
+    def _advance(self):
+        if self._tally is not None:
+            values, counts, codes, mass = self._tally
+            code = codes[self.cursor]
+            counts[code] -= 1
+            if mass is not None:
+                # Exactly 0 once the last card of a vector is gone, whatever the rounding
+                weight = catalog_weights(self.catalog)[self.pool[self.cursor]]
+                mass[code] = mass[code] - weight if counts[code] else 0.0
+        self.cursor += 1
+
+    def weighted(self):
+        return catalog_weights(self.catalog) is not None
+
+    def weights(self):
+        # Draw weights of the pool, None for an unweighted catalog
+        weights = catalog_weights(self.catalog)
+        return None if weights is None else weights[self.pool]
+
+    def tally(self, game=None):
+        # Distinct score vectors of the live cards and how many cards carry each (their total
+        # weight, for weighted catalogs). Built once per deck (codes run parallel to the pool),
+        # then kept current by every draw. With `game` (see hand_distribution) the vectors and
+        # codes of the whole pool are kept for the process, so the same deck loaded again
+        # only counts its live cards instead of sorting the pool's scores again.
+        if self._tally is None:
+            values, codes = self._codes(game)
+            counts = np.bincount(codes[self.cursor:], minlength=len(values))
+            weights = self.weights()
+            mass = None if weights is None else np.bincount(codes[self.cursor:], weights[self.cursor:], len(values))
+            self._tally = (values, counts, codes, mass)
+        values, counts, codes, mass = self._tally
+        return values, counts if mass is None else mass
+
+    def _codes(self, game):
+        index = tier_index(self.catalog)
+        key = (game, self.tier)
+        entry = None if game is None else _codes.get(key)
+        if entry is not None and entry[0] is index and np.array_equal(entry[1], self.pool):
+            _codes.move_to_end(key)
+            # take() reorders the codes along with the pool
+            return entry[2], entry[3].copy()
+
+        values, codes = np.unique(score_matrix(self.catalog)[self.pool], axis=0, return_inverse=True)
+        codes = codes.reshape(-1).astype(np.int32)
+        if game is not None:
+            _codes[key] = (index, self.pool.copy(), values, codes.copy())
+            while len(_codes) > TALLY_CACHE_SIZE:
+                _codes.popitem(last=False)
+        return values, codes
+
+    def live(self):
+        # Remaining cards in draw order (a view)
+        return self.pool[self.cursor:]
+
+    def rows(self):
+        return np.sort(self.live())
+
+    def frame(self):
+        return self.catalog.iloc[self.rows()]
+
+
+def make_decks(catalog, rng=None):
+    # Tier 4 (technology) and tier 6 (events) are drawn with replacement
+    return {
+        'df1': Deck(catalog, 1, rng=rng),
+        'df2': Deck(catalog, 2, rng=rng),
+        'df3': Deck(catalog, 3, rng=rng),
+        'df4': Deck(catalog, 4, replace=True),
+        'df5': Deck(catalog, 5, rng=rng),
+        'df6': Deck(catalog, 6, replace=True),
+    }
+
+
+# All decks of a game, and the ones that make up a hand, in table order
+DECK_NAMES = ['df1', 'df2', 'df3', 'df4', 'df5', 'df6']
+HAND_DECKS = ['df1', 'df2', 'df3', 'df4', 'df5']
+
+
+def deck_from_frame(catalog, df, tier, replace=False):
+    # Rebuild a Deck from an older state file that stored the remaining cards as a DataFrame
+    return Deck(catalog, tier, replace, rows=catalog.index.get_indexer(df.index))
+
+
+def rows_from_frame(catalog, df, tiers):
+    # Catalog rows of the cards in an older saved table, matched by tier and bonus text
+    # (those tables were re-indexed for display and no longer carry the row positions)
+    tier, bonus = catalog['tier'].to_numpy(), catalog['bonus'].to_numpy()
+    return np.array([np.flatnonzero((tier == k) & (bonus == name))[0] for k, name in zip(tiers, df['bonus'])])
+
+
+def score_matrix(catalog):
+    # The catalog's category columns as one float array, kept for the last catalog asked for
+    if _scores[0] is not catalog:
+        _scores[:] = [catalog, catalog[CATEGORIES].to_numpy(dtype=np.float64)]
+    return _scores[1]
+
+
+def _compact(rows):
+    # Row positions in the smallest integer type that holds the largest one
+    return rows.astype(np.min_scalar_type(int(rows.max(initial=0))))
+
+
+class Tables(MutableMapping):
+    # Player index -> dealt hand. A hand is stored as its five catalog rows; the styled
+    # DataFrame the page shows is built on first access and cached, never saved.
+
+    def __init__(self, catalog=None, hands=None):
+        self._catalog = catalog
+        self.hands = {}
+        self._frames = {}
+        for i, rows in (hands or {}).items():
+            self[i] = rows
+
+    catalog = Deck.catalog
+
+    def __getitem__(self, i):
+        if i not in self._frames:
+            rows = self.hands[i]
+            self._frames[i] = None if rows is None else hand_frame(self.catalog, rows)
+        return self._frames[i]
+
+    def __setitem__(self, i, rows):
+        self.hands[i] = None if rows is None else np.asarray(rows, dtype=np.int64)
+        self._frames.pop(i, None)
+
+    def __delitem__(self, i):
+        del self.hands[i]
+        self._frames.pop(i, None)
+
+    def hand_totals(self, i):
+        # Same as table_totals(self[i]), from the rows without building the frame
+        rows = self.hands.get(i)
+        if rows is None:
+            return np.zeros(len(CATEGORIES))
+        return score_matrix(self.catalog)[rows].sum(axis=0)
+
+    def totals(self, players):
+        # players x categories matrix, like player_totals() of the frames (no rows for no players)
+        if not players:
+            return np.zeros((0, len(CATEGORIES)))
+        return np.stack([self.hand_totals(i) for i in range(players)]).reshape(-1, len(CATEGORIES))
+
+    def __iter__(self):
+        return iter(self.hands)
+
+    def __len__(self):
+        return len(self.hands)
+
+    def __getstate__(self):
+        return {'hands': {i: None if rows is None else _compact(rows) for i, rows in self.hands.items()}}
+
+    def __setstate__(self, state):
+        self.__init__(None, state['hands'])
+
+
+def random_samples(df1, df2, df3, df4, df5, rng=None):
+    # One catalog row per tier; tiers 1, 2, 3 and 5 are drawn without replacement
+    return np.array([df1.draw(rng), df2.draw(rng), df3.draw(rng), df4.draw(rng), df5.draw(rng)])
+
+
+def styling(df):
+    df.index = ['Бонус 1: ', 'Бонус 2: ', 'Бонус 3: ', 'Технология: ', 'Нация: ']
+    df.drop(columns=[name for name in ('tier', WEIGHT_COLUMN) if name in df], inplace=True)
+
+    return df
+
+
+def deal_hand(df1, df2, df3, df4, df5, rng=None):
+    # One hand as catalog rows; None once a deck's cursor reached the end of its permutation
+    if len(df1) < 1 or len(df2) < 1 or len(df3) < 1 or len(df5) < 1:
+        return None
+
+    return random_samples(df1, df2, df3, df4, df5, rng)
+
+
+def hand_frame(catalog, rows):
+    # Rows only become a DataFrame here, at the display boundary
+    return styling(catalog.iloc[rows].copy())
+
+
+def random_distribution(df1, df2, df3, df4, df5, rng=None):
+    rows = deal_hand(df1, df2, df3, df4, df5, rng)
+    if rows is None:
+        return None
+
+    return hand_frame(df1.catalog, rows)
+
+
+# Tries in the first two rounds of a balanced deal's search; each pair of rounds doubles it up to `batch`
+FIRST_BATCH = 64
+# A balanced deal's search round only starts when this many times its predicted length still
+# fits the budget: a round tries twice as many deals as the last one of its kind, and bigger
+# batches cost a little more per deal
+ROUND_MARGIN = 1.5
+# Tries at a card not yet dealt in the game before _distinct_picks stops drawing at random
+REDRAWS = 16
+
+
+def _distinct_picks(n, players, games, rng, table=None):
+    # (games, players) distinct positions out of n, in the order players draw them: each
+    # column is drawn uniformly (or from the alias `table`) and drawn again where it repeats
+    # an earlier column of its game. That is a draw in proportion to what is left, as
+    # without replacement, at O(games * players**2) however large n is. Games still
+    # repeating a card after REDRAWS tries (nearly all the weight already taken) finish
+    # with exponential clocks over the whole pool.
+    available = n if table is None else table.support
+    if available < players:
+        raise ValueError(f'{players} players need {players} cards, the pool has {available}')
+    draw = (lambda size: rng.integers(n, size=size)) if table is None else (lambda size: table.sample(rng, size))
+    picks = np.empty((games, players), dtype=np.int64)
+    for j in range(players):
+        column = draw(games)
+        clash = np.flatnonzero((picks[:, :j] == column[:, None]).any(axis=1))
+        for _ in range(REDRAWS):
+            if not len(clash):
+                break
+            column[clash] = draw(len(clash))
+            clash = clash[(picks[clash, :j] == column[clash, None]).any(axis=1)]
+        if len(clash):
+            keys = rng.exponential(size=(len(clash), n))
+            if table is not None:
+                with np.errstate(divide='ignore'):
+                    keys /= table.weights
+            np.put_along_axis(keys, picks[clash, :j], np.inf, axis=1)
+            column[clash] = keys.argmin(axis=1)
+        picks[:, j] = column
+    return picks
+
+
+def deal_batch(pools, players, games, rng, replace=(False, False, False, True, False), weights=None):
+    # (games, players, len(pools)) catalog rows, `players` cards per deck drawn as at the
+    # table: distinct cards from decks without replacement (see _distinct_picks), any from
+    # the others. `weights` (an array, an AliasTable or None per pool) draws by weight.
+    return _cards(pools, deal_positions([len(pool) for pool in pools], players, games, rng, replace, weights))
+
+
+def deal_positions(sizes, players, games, rng, replace=(False, False, False, True, False), weights=None):
+    # The draws of deal_batch() as positions into pools of these sizes
+    spots = np.empty((games, players, len(sizes)), dtype=np.int64)
+    for k, n in enumerate(sizes):
+        w = None if weights is None else weights[k]
+        table = w if w is None or isinstance(w, AliasTable) else AliasTable(w)
+        if not replace[k]:
+            spots[:, :, k] = _distinct_picks(n, players, games, rng, table)
+        elif table is None:
+            spots[:, :, k] = rng.integers(n, size=(games, players))
+        else:
+            spots[:, :, k] = table.sample(rng, (games, players))
+
+    return spots
+
+
+def _cards(pools, spots):
+    # Catalog rows at positions `spots` (..., len(pools)) of the pools
+    cards = np.empty(spots.shape, dtype=np.int64)
+    for k, pool in enumerate(pools):
+        cards[..., k] = pool[spots[..., k]]
+    return cards
+
+
+def spread(totals):
+    # Largest gap between two players in any category
+    return (totals.max(axis=-2) - totals.min(axis=-2)).max(axis=-1)
+
+
+def balanced_deal(decks, players, tolerance=4.0, budget=0.05, rng=None, batch=2048, rounds=None):
+    # Deal `players` hands whose category totals differ by at most `tolerance`.
+    # One plain deal, then search rounds while the time budget allows, alternating a batch
+    # of random deals (even rounds) and random single-card moves from the best deal found
+    # (odd rounds). Rounds 2k and 2k + 1 try min(batch, FIRST_BATCH * 2**k) each, and a
+    # round only starts when the last round of its kind, scaled to its size (and by
+    # ROUND_MARGIN), would still end within the budget; otherwise the best deal so far is returned.
+    # The budget bounds the search only: weighted catalogs first build an alias table over each
+    # deck's live cards, which on a million-card catalog alone takes longer than 50 ms.
+    # Returns each player's hand as catalog rows and the number of search rounds used; passing that number back
+    # as `rounds` (with the same rng state) replays the search exactly, whatever the clock says.
+    deadline = time.perf_counter() + budget
+    rng = _rng if rng is None else rng
+    hand_decks = [decks[name] for name in HAND_DECKS]
+    if any(len(deck) < (1 if deck.replace else players) for deck in hand_decks):
+        return None, 0
+
+    # The live cards as views; the search only ever draws positions into them
+    pools = [deck.live() for deck in hand_decks]
+    sizes = [len(pool) for pool in pools]
+    tables = [AliasTable(deck.weights()[deck.cursor:]) if deck.weighted() else None for deck in hand_decks]
+    replace = np.array([deck.replace for deck in hand_decks])
+    values = score_matrix(hand_decks[0].catalog)
+
+    # The best deal so far, as catalog rows and as positions into the pools
+    spot = deal_positions(sizes, players, 1, rng, replace, tables)[0]
+    hand = _cards(pools, spot)
+    cost = spread(values[hand].sum(axis=1))
+
+    used = 0
+    # Seconds per deal and per move, as the last round of each kind took
+    per_try = [0.0, 0.0]
+    while cost > tolerance:
+        moves = used % 2
+        size = min(batch, FIRST_BATCH << used // 2)
+        if rounds is None:
+            started = time.perf_counter()
+            if started + per_try[moves] * size * ROUND_MARGIN > deadline:
+                break
+        elif used >= rounds:
+            break
+        used += 1
+
+        if not moves:
+            spots = deal_positions(sizes, players, size, rng, replace, tables)
+            cand = _cards(pools, spots)
+            costs = spread(values[cand].sum(axis=2))
+        else:
+            # Local search: replace one card of one player with a random card of the same tier
+            cand = np.repeat(hand[None], size, axis=0)
+            slot_player = rng.integers(players, size=size)
+            slot_tier = rng.integers(len(pools), size=size)
+            u = rng.random(size)
+            new_spots = np.empty(size, dtype=np.int64)
+            new_cards = np.empty(size, dtype=np.int64)
+            for k, pool in enumerate(pools):
+                tier = slot_tier == k
+                new_spots[tier] = (u[tier] * len(pool)).astype(np.int64)
+                new_cards[tier] = pool[new_spots[tier]]
+            cand[np.arange(size), slot_player, slot_tier] = new_cards
+
+            # Drop moves that would deal a card twice from a deck without replacement
+            column = cand[np.arange(size), :, slot_tier]
+            dupes = (column == new_cards[:, None]).sum(axis=1) > 1
+            dupes &= ~replace[slot_tier]
+            costs = spread(values[cand].sum(axis=2))
+            costs[dupes] = np.inf
+        best = int(costs.argmin())
+        if costs[best] < cost:
+            hand, cost = cand[best], costs[best]
+            if not moves:
+                spot = spots[best]
+            else:
+                spot = spot.copy()
+                spot[slot_player[best], slot_tier[best]] = new_spots[best]
+        if rounds is None:
+            per_try[moves] = (time.perf_counter() - started) / size
+
+    for k, deck in enumerate(hand_decks):
+        deck.take(hand[:, k], spot[:, k])
+
+    return list(hand), used
+
+
+def random_event(df6, rng=None):
+    # The event as a catalog row; event_frame() makes the table the page shows
+    return df6.draw(rng)
+
+
+def event_frame(catalog, row):
+    df_event = catalog.iloc[[row]].copy()
+    df_event.index = [':']
+
+    return df_event
+
+
+def percent(value):
+    value = value * 100
+
+    return str(round(value)) + '%'
+
+
+def shuffle_slice(arr, rng=None):
+    # Shuffle everyone but the first player
+    rng = _rng if rng is None else rng
+    copy = arr[1:]
+    arr[1:] = [copy[i] for i in rng.permutation(len(copy))]
+
+    return arr
+
+
+def player_seating(players):
+    import pandas as pd
+    data = {
+        '0': ['1', '2', '3', '4'],
+        '  ': ['', (players[1] if len(players) > 1 else ''), '', ''],
+        '   ': [(players[4] if len(players) == 5 else ''), ' ', ' ', (players[3] if len(players) > 3 else '')],
+        '    ': [(players[2] if len(players) > 2 else ''), ' ', ' ', players[0]],
+    }
+
+    df = pd.DataFrame(data).set_index('0')
+
+    return df
+
+
+def table_totals(table):
+    # Summed bonus values of one hand, by category; zeros for a seat without a hand
+    if table is None:
+        return np.zeros(len(CATEGORIES))
+    return table[CATEGORIES].to_numpy(dtype=np.float64).sum(axis=0)
+
+
+def player_totals(tables):
+    # players x categories matrix of summed bonus values
+    return np.stack([table_totals(table) for table in tables]).reshape(-1, len(CATEGORIES))
+
+
+def _share(values, axis):
+    total = values.sum(axis=axis, keepdims=True)
+    return np.divide(values, total, out=np.zeros_like(values), where=total != 0)
+
+
+def odds_matrix(totals):
+    # totals has shape (..., players, categories); leading axes are batches of games.
+    # Returns the per-category shares, each player's best weighted victory type and
+    # the overall victory share, all as arrays.
+    totals = np.asarray(totals, dtype=np.float64)
+
+    shares = _share(totals, axis=-2)
+    scores = totals * WIN_WEIGHTS
+    best = scores.argmax(axis=-1)
+    best_scores = np.take_along_axis(scores, best[..., None], axis=-1)[..., 0]
+    overall = _share(best_scores, axis=-1)
+
+    return shares, best, overall
+
+
+def find_odds(tables, players):
+    return odds_tables(player_totals(tables), players)
+
+
+def odds_tables(totals, players):
+    # find_odds from an already summed players x categories matrix
+    import pandas as pd
+    shares, best, overall = odds_matrix(totals)
+
+    df = pd.DataFrame(shares.T, columns=players, index=pd.Index(VICTORY_TYPES, name='Вид победы'))
+
+    ranking = np.argsort(-overall, kind='stable')
+    winner = pd.DataFrame({
+        'Leader': [players[i] for i in ranking],
+        'Victory Type': [WIN_TYPES[k] for k in best[ranking]],
+        'Probability': overall[ranking],
+    })
+
+    return df, winner
+
+
+# Exact distribution of a fresh hand's category totals and the reroll advice built on it,
+# memoized by the decks' live cards (and the tables, for the advice) for one catalog
+HAND_CACHE_SIZE = 32
+# Largest dense grid of integer totals the convolution folds through bincount
+HAND_GRID_LIMIT = 1 << 24
+_hands = OrderedDict()
+_advice = OrderedDict()
+
+
+def _recall(cache, key, index):
+    # A memoized value, if it was worked out over the catalog with this tier index
+    entry = cache.get(key)
+    if entry is None or entry[0] is not index:
+        return None
+    cache.move_to_end(key)
+    return entry[1]
+
+
+def _remember(cache, key, value, index):
+    cache[key] = (index, value)
+    while len(cache) > HAND_CACHE_SIZE:
+        cache.popitem(last=False)
+    return value
+
+
+def _fold(tallies):
+    # One card from each deck, by weight from its live cards: the totals are the
+    # convolution of the per-deck tallies. Integer scores are added as mixed-radix keys
+    # on a dense grid; anything else merges equal sums with np.unique.
+    live = [(values[counts > 0], counts[counts > 0] / counts.sum()) for values, counts in tallies]
+    low = sum(values.min(axis=0) for values, p in live)
+    shape = tuple(int(n) + 1 for n in sum(values.max(axis=0) - values.min(axis=0) for values, p in live))
+    integral = all(np.array_equal(values, np.round(values)) for values, p in live)
+
+    if integral and np.prod(shape, dtype=np.float64) <= HAND_GRID_LIMIT:
+        keys, probs = np.zeros(1, dtype=np.int64), np.ones(1)
+        for values, p in live:
+            offsets = np.ravel_multi_index((values - values.min(axis=0)).astype(np.int64).T, shape)
+            grid = np.bincount((keys[:, None] + offsets).ravel(), (probs[:, None] * p).ravel(), minlength=int(np.prod(shape)))
+            keys = np.flatnonzero(grid)
+            probs = grid[keys]
+        return np.stack(np.unravel_index(keys, shape), axis=1) + low, probs
+
+    totals, probs = np.zeros((1, len(CATEGORIES))), np.ones(1)
+    for values, p in live:
+        totals, inverse = np.unique((totals[:, None] + values).reshape(-1, len(CATEGORIES)), axis=0, return_inverse=True)
+        probs = np.bincount(inverse.reshape(-1), (probs[:, None] * p).ravel())
+    return totals, probs
+
+
+def _tallies(decks, game=None):
+    return [decks[name].tally(game) for name in HAND_DECKS]
+
+
+def _hand_key(decks, game):
+    # The live cards of the decks as a memo key: their cursors when `game` says which
+    # permutations the decks hold, so nothing is built for a hit; else the tallies themselves
+    if game is not None:
+        return game, tuple(decks[name].cursor for name in HAND_DECKS)
+    return tuple(values.tobytes() + counts.tobytes() for values, counts in _tallies(decks))
+
+
+def hand_distribution(decks, game=None):
+    # (totals, probabilities) of every distinct hand a reroll can produce; None once a deck is empty.
+    # `game` is anything that is equal only for decks shuffled into the same permutations
+    # (state_manager.game_key: the seed and setup), or None to compare the decks' cards.
+    index = tier_index(decks['df1'].catalog)
+    key = _hand_key(decks, game)
+    dist = _recall(_hands, key, index)
+    if dist is not None:
+        return dist
+    tallies = _tallies(decks, game)
+    if not all((counts > 0).any() for values, counts in tallies):
+        return None
+
+    return _remember(_hands, key, _fold(tallies), index)
+
+
+def reroll_odds(totals, player, decks, game=None):
+    # What a reroll is worth to `player`: their per-category and overall victory shares now
+    # and in expectation over every possible new hand (the other tables stay as they are),
+    # plus the chance the overall share goes up or down. Same formulas as find_odds.
+    totals = np.asarray(totals, dtype=np.float64)
+    index = tier_index(decks['df1'].catalog)
+    key = (_hand_key(decks, game), totals.tobytes(), player)
+    advice = _recall(_advice, key, index)
+    if advice is not None:
+        return advice
+
+    dist = hand_distribution(decks, game)
+    if dist is None:
+        return None
+    outcomes, probs = dist
+
+    shares_now, best_now, overall_now = odds_matrix(totals)
+    others = np.delete(totals, player, axis=0)
+    other_totals = np.broadcast_to(others.sum(axis=0), outcomes.shape)
+    other_best = (others * WIN_WEIGHTS).max(axis=1).sum()
+
+    shares = _share(np.stack([outcomes, other_totals], axis=-2), axis=-2)[:, 0]
+    best = (outcomes * WIN_WEIGHTS).max(axis=1)
+    overall = _share(np.stack([best, np.full_like(best, other_best)], axis=-1), axis=-1)[:, 0]
+
+    return _remember(_advice, key, {
+        'shares_now': shares_now[player],
+        'shares_expected': probs @ shares,
+        'overall_now': overall_now[player],
+        'overall_expected': probs @ overall,
+        'p_better': probs[overall > overall_now[player] + 1e-12].sum(),
+        'p_worse': probs[overall < overall_now[player] - 1e-12].sum(),
+    }, index)
@@ -0,0 +1,81 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_ROOM = 'default'
+ROOMS_DIR = 'rooms'
+ROOM_PATTERN = re.compile(r'[A-Za-z0-9_-]{1,64}')
+
+# Hot rooms are kept in memory as encoded snapshots, capped in total size;
+# rooms not touched for ROOM_TTL seconds are dropped (their state is already on disk)
+ROOM_CACHE_BYTES = 64 * 1024 * 1024
+ROOM_TTL = 30 * 60
+
+
+def check_room(room):
+    room = DEFAULT_ROOM if room is None else str(room)
+    if not ROOM_PATTERN.fullmatch(room):
+        raise ValueError(f'Invalid room id {room!r}: use up to 64 letters, digits, "-" or "_"')
+    return room
+
+
+def room_path(room, default_path, extension):
+    # The default room keeps the original file names so existing games carry on
+    room = check_room(room)
+    if room == DEFAULT_ROOM:
+        return default_path
+    return os.path.join(ROOMS_DIR, room + extension)
+
+
+class RoomCache:
+    # LRU of room -> (version, encoded state, last access), bounded by bytes and idle time
+
+    def __init__(self, max_bytes=ROOM_CACHE_BYTES, ttl=ROOM_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._rooms = OrderedDict()
+        self._bytes = 0
+
+    @property
+    def size(self):
+        return self._bytes
+
+    def __len__(self):
+        return len(self._rooms)
+
+    def get(self, room, version):
+        with self._lock:
+            self._evict()
+            entry = self._rooms.get(room)
+            if entry is None or entry[0] != version:
+                return None
+            self._rooms[room] = (entry[0], entry[1], time.monotonic())
+            self._rooms.move_to_end(room)
+            return entry[1]
+
+    def put(self, room, version, data):
+        with self._lock:
+            self._drop(room)
+            self._rooms[room] = (version, data, time.monotonic())
+            self._bytes += len(data)
+            self._evict()
+
+    def discard(self, room):
+        with self._lock:
+            self._drop(room)
+
+    def _drop(self, room):
+        entry = self._rooms.pop(room, None)
+        if entry is not None:
+            self._bytes -= len(entry[1])
+
+    def _evict(self):
+        cutoff = time.monotonic() - self.ttl
+        while self._rooms:
+            room, (version, data, touched) = next(iter(self._rooms.items()))
+            if self._bytes <= self.max_bytes and touched >= cutoff:
+                break
+            self._drop(room)
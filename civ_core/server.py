@@ -0,0 +1,558 @@
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import os
+import pickle
+import signal
+import struct
+import traceback
+from http import HTTPStatus
+from urllib.parse import urlsplit
+from . import state_manager
+from .metrics import metrics, span
+from .random_generator import odds_matrix
+from .catalog import load_catalog
+from .rooms import check_room
+from .storage import bind_catalog, encode_state
+
+HOST = '127.0.0.1'
+PORT = int(os.environ.get('CIV_API_PORT', 8765))
+# Rooms changed since the last write are committed this often (s); everything that
+# happened in between lands in one write
+FLUSH_INTERVAL = 0.5
+# Largest request body or WebSocket message accepted
+MAX_BODY = 64 * 1024
+JSON = 'application/json; charset=utf-8'
+WS_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC11B65'
+# Bounds of the arguments a request may pass: seats at a table, characters in a name and
+# seeds (new_seed() draws 128 bits)
+MAX_PLAYERS = 32
+MAX_NAME = 64
+SEED_BITS = 128
+
+_log = logging.getLogger(__name__)
+
+# JSON arguments of each operation as (name, type, default), in the order the functions in
+# state_manager.OPERATIONS take them; REQUIRED arguments have no default
+REQUIRED = object()
+PARAMS = {
+    'initialize': [('players', list, REQUIRED), ('balanced', bool, False), ('seed', int, None)],
+    'reset': [('players', list, REQUIRED), ('balanced', bool, False), ('seed', int, None)],
+    'reroll': [('player', int, REQUIRED)],
+    'lock': [('player', int, REQUIRED), ('lock', bool, True)],
+    'event': [],
+    'rename': [('players', list, REQUIRED)],
+    'undo': [],
+    'redo': [],
+}
+
+
+class ApiError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def _arguments(op, args):
+    if not isinstance(args, dict):
+        raise ApiError(HTTPStatus.BAD_REQUEST, "'args' must be a JSON object")
+    values = []
+    for name, kind, default in PARAMS[op]:
+        value = args.get(name, default)
+        if value is REQUIRED:
+            raise ApiError(HTTPStatus.BAD_REQUEST, f'{op} needs {name!r}')
+        if value is not None and not isinstance(value, kind) or isinstance(value, bool) and kind is int:
+            raise ApiError(HTTPStatus.BAD_REQUEST, f'{name!r} must be {kind.__name__}')
+        if name == 'players' and not (1 <= len(value) <= MAX_PLAYERS and all(
+                isinstance(player, str) and player.strip() and len(player) <= MAX_NAME for player in value)):
+            raise ApiError(HTTPStatus.BAD_REQUEST,
+                           f"'players' must be 1 to {MAX_PLAYERS} names of 1 to {MAX_NAME} characters")
+        if name == 'seed' and value is not None and not 0 <= value < 1 << SEED_BITS:
+            raise ApiError(HTTPStatus.BAD_REQUEST, f"'seed' must be from 0 to 2**{SEED_BITS} - 1")
+        values.append(value)
+    return values
+
+
+def _content_length(headers):
+    # The body size a request announces, or None if the header is not a decimal number
+    value = headers.get('content-length') or '0'
+    return int(value) if value.isascii() and value.isdigit() else None
+
+
+def _check_seat(state, player):
+    if not 0 <= player < len(state['players']):
+        raise ApiError(HTTPStatus.BAD_REQUEST, f"'player' must be a seat from 0 to {len(state['players']) - 1}")
+
+
+class Room:
+    # One game held in memory: its state, the version last written to storage and whether
+    # anything happened since
+
+    def __init__(self, name, state):
+        self.name = name
+        self.state = state
+        self.persisted = None if state is None else state['version']
+        self.dirty = False
+        self.names = None
+        self.sockets = set()
+        # Operations and sockets using the room; a room without a game is only cached while held
+        self.holds = 0
+        # summary() of the current version as JSON bytes, dropped on every change
+        self.encoded = None
+
+
+class GameServer:
+    # The game rooms of one process. Operations change the in-memory state in the event loop
+    # and bump its version; a background task commits dirty rooms with compare-and-swap
+    # against the version it last wrote, so a game changed behind the server's back is
+    # reloaded instead of overwritten. All rooms deal from one copy of the catalog.
+
+    def __init__(self, flush_interval=FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self.rooms = {}
+        self._loading = {}
+        self.catalog = None
+        self._bonus = None
+
+    async def _catalog(self):
+        if self.catalog is None:
+            catalog = await asyncio.to_thread(load_catalog)
+            self._bonus = catalog['bonus'].to_numpy()
+            self.catalog = catalog
+        return self.catalog
+
+    async def _load(self, name):
+        state = await asyncio.to_thread(state_manager.load_state, name)
+        return None if state is None else bind_catalog(state, await self._catalog())
+
+    async def room(self, name):
+        try:
+            name = check_room(name)
+        except ValueError as e:
+            raise ApiError(HTTPStatus.BAD_REQUEST, str(e))
+        room = self.rooms.get(name)
+        if room is None:
+            lock = self._loading.setdefault(name, asyncio.Lock())
+            async with lock:
+                room = self.rooms.get(name)
+                if room is None:
+                    room = Room(name, await self._load(name))
+                    # Any name can be asked for: only rooms with a game stay in memory
+                    if room.state is not None:
+                        room = self.rooms.setdefault(name, room)
+            if not lock.locked():
+                self._loading.pop(name, None)
+        return room
+
+    def hold(self, room):
+        # The room to use from now on, cached until the matching release()
+        room = self.rooms.setdefault(room.name, room)
+        room.holds += 1
+        return room
+
+    def release(self, room):
+        room.holds -= 1
+        if room.state is None and not room.holds and self.rooms.get(room.name) is room:
+            del self.rooms[room.name]
+
+    async def execute(self, room, op, args, sender=None):
+        # Runs `op` on a room from hold(); only known operations get a span of their own
+        if op not in PARAMS:
+            raise ApiError(HTTPStatus.NOT_FOUND, f'unknown operation {op!r}')
+        values = _arguments(op, args)
+        with span(f'api.{op}'):
+            return await self._execute(room, op, values, sender)
+
+    async def _execute(self, room, op, values, sender):
+        if op == 'reset' and room.state is None:
+            op = 'initialize'
+
+        if op in ('initialize', 'reset'):
+            # Dealing (a balanced deal searches for up to BALANCE_BUDGET) runs off the event loop
+            fresh = await asyncio.to_thread(state_manager.build_state, *values, catalog=await self._catalog())
+            if op == 'initialize' or room.state is None:
+                fresh['version'] = (room.state['version'] if room.state else room.persisted or 0)
+                state = fresh
+            else:
+                state = self._working_copy(room)
+                state_manager.apply_mutation(state, lambda state: state_manager.swap_game(state, fresh))
+        else:
+            if room.state is None:
+                raise ApiError(HTTPStatus.NOT_FOUND, f'no game in room {room.name!r}')
+            if op in ('reroll', 'lock'):
+                _check_seat(room.state, values[0])
+            # The operation runs on a copy that replaces the game only once it went through, so
+            # one that fails half way leaves nothing behind for the flusher to write
+            state = self._working_copy(room)
+            apply, record = state_manager.OPERATIONS[op]
+            if state_manager.apply_mutation(state, lambda state: apply(state, *values), record) is False:
+                return False
+
+        room.state = state
+        room.state['version'] += 1
+        room.dirty = True
+        room.encoded = None
+        if op == 'rename':
+            room.names = values[0]
+        self.notify(room, sender)
+        return True
+
+    def _working_copy(self, room):
+        return bind_catalog(_snapshot(room.state), self.catalog)
+
+    def summary(self, room):
+        # The game as plain JSON: seats in order, cards as catalog rows with their text
+        state = room.state
+        bonus = self._bonus
+        hands = state['tables'].hands
+        seats = range(len(state['players']))
+        overall = odds_matrix(state['totals'])[2]
+
+        return {
+            'room': room.name,
+            'version': state['version'],
+            'seed': None if state.get('seed') is None else str(state['seed']),
+            'players': list(state['players']),
+            'hands': [None if hands.get(i) is None else {'rows': hands[i].tolist(), 'bonuses': bonus[hands[i]].tolist()}
+                      for i in seats],
+            'player_flags': [bool(state['player_flags'].get(i, False)) for i in seats],
+            'locked': [bool(state.get('locked', {}).get(i, False)) for i in seats],
+            'event': {'row': state['random_event'], 'text': bonus[state['random_event']]},
+            'map_maker': state['game_info']['map_maker'],
+            'first_player': state['game_info']['first_player'],
+            'odds': overall.tolist(),
+            'can_undo': state_manager.can_undo(state),
+            'can_redo': state_manager.can_redo(state),
+        }
+
+    def summary_json(self, room):
+        # Readers far outnumber changes: each version is encoded once
+        if room.encoded is None:
+            room.encoded = json.dumps(self.summary(room), ensure_ascii=False).encode('utf-8')
+        return room.encoded
+
+    def reply(self, room, head):
+        # `head` plus the game under "state", without decoding the cached summary
+        return json.dumps(head, ensure_ascii=False).encode('utf-8')[:-1] + b', "state": ' + self.summary_json(room) + b'}'
+
+    def notify(self, room, sender=None):
+        if not room.sockets:
+            return
+        message = frame(1, json.dumps({'event': 'changed', 'room': room.name, 'version': room.state['version']}).encode())
+        for writer in list(room.sockets):
+            if writer is sender:
+                continue
+            if writer.is_closing():
+                room.sockets.discard(writer)
+            else:
+                writer.write(message)
+
+    # Persistence
+
+    async def run_flusher(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                # A failed write leaves the room dirty; the next round tries again
+                traceback.print_exc()
+
+    async def flush(self):
+        for room in list(self.rooms.values()):
+            if not room.dirty:
+                continue
+            # Snapshot in the loop, write in a thread; later operations mark the room dirty again
+            snapshot = _snapshot(room.state)
+            names = room.names
+            room.dirty, room.names = False, None
+            try:
+                written = await asyncio.to_thread(self._write, room.name, snapshot, room.persisted, names)
+            except Exception:
+                room.dirty = True
+                room.names = room.names or names
+                raise
+            if written:
+                room.persisted = snapshot['version']
+                continue
+            # Somebody else committed to this room: their game wins, ours is reloaded
+            _log.warning('room %r changed in storage, dropping unsaved changes', room.name)
+            room.state = await self._load(room.name)
+            room.persisted = None if room.state is None else room.state['version']
+            room.dirty = False
+            room.encoded = None
+            if room.state is not None:
+                self.notify(room)
+            elif not room.holds:
+                del self.rooms[room.name]
+
+    @staticmethod
+    def _write(name, state, expected, names):
+        if not state_manager.commit_state(state, expected, name, version=state['version']):
+            return False
+        if names is not None:
+            state_manager.save_player_names(names, name)
+        return True
+
+    # HTTP
+
+    async def route(self, method, path, body):
+        parts = [part for part in urlsplit(path).path.split('/') if part]
+        if parts == ['health']:
+            return HTTPStatus.OK, {'rooms': len(self.rooms)}, {}
+        if len(parts) < 2 or parts[0] != 'rooms' or len(parts) > 3:
+            raise ApiError(HTTPStatus.NOT_FOUND, f'no such path {path!r}')
+        room = await self.room(parts[1])
+
+        if method == 'GET':
+            if parts[2:] == ['version']:
+                # Cheap enough to poll: what clients watching the room compare against
+                return HTTPStatus.OK, {'version': None if room.state is None else room.state['version']}, {}
+            if room.state is None:
+                raise ApiError(HTTPStatus.NOT_FOUND, f'no game in room {room.name!r}')
+            if parts[2:] == ['state']:
+                # The whole state in the storage encoding, for clients that run the engine themselves
+                return HTTPStatus.OK, encode_state(room.state), {'X-Civ-Version': room.state['version']}
+            if len(parts) == 2:
+                return HTTPStatus.OK, self.summary_json(room), {'Content-Type': JSON}
+            raise ApiError(HTTPStatus.NOT_FOUND, f'no such path {path!r}')
+
+        if method == 'POST' and len(parts) == 3:
+            try:
+                args = json.loads(body) if body else {}
+            except ValueError:
+                raise ApiError(HTTPStatus.BAD_REQUEST, 'body must be a JSON object')
+            if not isinstance(args, dict):
+                raise ApiError(HTTPStatus.BAD_REQUEST, 'body must be a JSON object')
+            room = self.hold(room)
+            try:
+                changed = await self.execute(room, parts[2], args)
+            finally:
+                self.release(room)
+            return HTTPStatus.OK, self.reply(room, {'changed': changed}), {'Content-Type': JSON}
+
+        raise ApiError(HTTPStatus.METHOD_NOT_ALLOWED, f'{method} is not supported here')
+
+    async def handle(self, reader, writer):
+        # One connection: keep-alive HTTP/1.1 requests, or a WebSocket after an upgrade
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                method, path, version, headers = _parse_head(head)
+                if headers.get('upgrade', '').lower() == 'websocket':
+                    await self.websocket(reader, writer, headers)
+                    break
+
+                length = _content_length(headers)
+                if length is None:
+                    writer.write(_response(HTTPStatus.BAD_REQUEST, {'error': 'bad Content-Length'}, {}, False))
+                    break
+                if length > MAX_BODY:
+                    writer.write(_response(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {'error': 'body too large'}, {}, False))
+                    break
+                body = await reader.readexactly(length) if length else b''
+
+                try:
+                    status, payload, extra = await self.route(method, path, body)
+                except ApiError as e:
+                    status, payload, extra = e.status, {'error': str(e)}, {}
+                except Exception as e:
+                    traceback.print_exc()
+                    status, payload, extra = HTTPStatus.INTERNAL_SERVER_ERROR, {'error': repr(e)}, {}
+                keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+                writer.write(_response(status, payload, extra, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    # WebSocket: JSON messages {"id", "room", "op", "args"}; "get" returns the game, any
+    # other op runs it. Every room a socket has used pushes {"event": "changed"} on changes.
+
+    async def websocket(self, reader, writer, headers):
+        key = headers.get('sec-websocket-key', '').encode()
+        accept = base64.b64encode(hashlib.sha1(key + WS_GUID).digest()).decode()
+        writer.write(('HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                      f'Sec-WebSocket-Accept: {accept}\r\n\r\n').encode())
+        rooms = set()
+        try:
+            while True:
+                opcode, data = await read_frame(reader)
+                if opcode == 8:
+                    writer.write(frame(8, data[:2]))
+                    break
+                if opcode == 9:
+                    writer.write(frame(10, data))
+                    continue
+                if opcode != 1:
+                    continue
+                writer.write(frame(1, await self._message(data, writer, rooms)))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            for room in rooms:
+                room.sockets.discard(writer)
+                self.release(room)
+
+    async def _message(self, data, writer, rooms):
+        # The reply to one message, encoded
+        try:
+            message = json.loads(data)
+            if not isinstance(message, dict):
+                raise ValueError
+        except ValueError:
+            return b'{"error": "messages must be JSON objects"}'
+        reply = {'id': message.get('id')}
+        try:
+            room = await self.room(message.get('room'))
+            if room not in rooms:
+                # The socket holds the room so it hears about a game started there later
+                room = self.hold(room)
+                room.sockets.add(writer)
+                rooms.add(room)
+            op = message.get('op', 'get')
+            if op == 'get':
+                if room.state is None:
+                    raise ApiError(HTTPStatus.NOT_FOUND, f'no game in room {room.name!r}')
+            else:
+                reply['changed'] = await self.execute(room, op, message.get('args') or {}, writer)
+            return self.reply(room, reply)
+        except ApiError as e:
+            reply['error'] = str(e)
+        except Exception as e:
+            traceback.print_exc()
+            reply['error'] = repr(e)
+        return json.dumps(reply, ensure_ascii=False).encode('utf-8')
+
+
+def _snapshot(state):
+    # A copy of the state for writing while the loop goes on changing the original. Steps on
+    # the undo history are never modified once pushed, so the copy shares them; only the
+    # game itself (a couple of KB) is copied.
+    history = state.get('history')
+    game = {key: value for key, value in state.items() if key != 'history'}
+    snapshot = pickle.loads(pickle.dumps(game, protocol=pickle.HIGHEST_PROTOCOL))
+    if history is not None:
+        snapshot['history'] = {name: list(steps) for name, steps in history.items()}
+    return snapshot
+
+
+def _parse_head(head):
+    lines = head.decode('latin-1').split('\r\n')
+    method, path, version = lines[0].split(' ', 2)
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+    return method, path, version, headers
+
+
+def _response(status, payload, extra, keep_alive):
+    # `payload` is a JSON value, or bytes whose Content-Type (if not binary) comes in `extra`
+    extra = dict(extra)
+    if isinstance(payload, bytes):
+        body, kind = payload, extra.pop('Content-Type', 'application/octet-stream')
+    else:
+        body, kind = json.dumps(payload, ensure_ascii=False).encode('utf-8'), JSON
+    head = [f'HTTP/1.1 {status.value} {status.phrase}', f'Content-Type: {kind}', f'Content-Length: {len(body)}',
+            f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+    head += [f'{name}: {value}' for name, value in extra.items()]
+    return ('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body
+
+
+def frame(opcode, payload, mask=False):
+    # One final WebSocket frame; clients must mask what they send, servers must not
+    head = bytearray([0x80 | opcode])
+    bit = 0x80 if mask else 0
+    if len(payload) < 126:
+        head.append(bit | len(payload))
+    elif len(payload) < 1 << 16:
+        head += bytes([bit | 126]) + struct.pack('!H', len(payload))
+    else:
+        head += bytes([bit | 127]) + struct.pack('!Q', len(payload))
+    if mask:
+        key = os.urandom(4)
+        return bytes(head) + key + _unmask(payload, key)
+    return bytes(head) + payload
+
+
+def _unmask(data, key):
+    n = len(data)
+    stream = (key * (n // 4 + 1))[:n]
+    return (int.from_bytes(data, 'big') ^ int.from_bytes(stream, 'big')).to_bytes(n, 'big')
+
+
+async def read_frame(reader):
+    # (opcode, payload) of the next message, joining continuation frames
+    message, opcode = b'', None
+    while True:
+        b1, b2 = await reader.readexactly(2)
+        length = b2 & 0x7F
+        if length == 126:
+            length = struct.unpack('!H', await reader.readexactly(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', await reader.readexactly(8))[0]
+        if len(message) + length > MAX_BODY:
+            raise ValueError('message too large')
+        key = await reader.readexactly(4) if b2 & 0x80 else None
+        data = await reader.readexactly(length)
+        if key is not None:
+            data = _unmask(data, key)
+        if b1 & 0x0F >= 8:
+            # Control frames may arrive between the fragments of a message
+            return b1 & 0x0F, data
+        opcode = opcode or b1 & 0x0F
+        message += data
+        if b1 & 0x80:
+            return opcode, message
+
+
+async def serve(host=HOST, port=PORT, flush_interval=FLUSH_INTERVAL):
+    # Runs until SIGINT/SIGTERM, then writes every unsaved room before returning
+    state_manager.API_URL = None
+    # Rooms are already written in batches by the flusher below
+    state_manager.WRITE_MAX_DELAY = 0
+    metrics.start()
+    server = GameServer(flush_interval)
+    listener = await asyncio.start_server(server.handle, host, port, limit=MAX_BODY)
+    flusher = asyncio.create_task(server.run_flusher())
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):  # Windows: Ctrl+C raises KeyboardInterrupt instead
+            pass
+
+    print(f'serving on http://{host}:{port}', flush=True)
+    try:
+        await stop.wait()
+    finally:
+        listener.close()
+        flusher.cancel()
+        await server.flush()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='JSON API (HTTP and WebSocket) for game operations')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--flush-interval', type=float, default=FLUSH_INTERVAL,
+                        help='seconds between background writes of changed rooms')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    asyncio.run(serve(args.host, args.port, args.flush_interval))
@@ -0,0 +1,740 @@
+import os
+import atexit
+import json
+import logging
+import pickle
+import time
+import numpy as np
+import random
+import threading
+from collections import OrderedDict
+from .catalog import load_catalog
+from .random_generator import (deal_hand, balanced_deal, random_event, shuffle_slice, make_decks, Tables,
+                               odds_tables, DECK_NAMES)
+from .notify import hub
+from .metrics import timed
+from .rooms import DEFAULT_ROOM, ROOMS_DIR, RoomCache, check_room, room_path
+from .storage import BACKENDS, StateConflictError, StateCorruptError, bind_catalog, upgrade_state
+
+STATE_FILE = 'game_state.pkl'
+STATE_DB = 'game_state.db'
+# 'pickle' (one file, rewritten per commit) or 'sqlite' (WAL database, row-level updates)
+STATE_BACKEND = os.environ.get('CIV_STATE_BACKEND', 'pickle')
+PLAYER_NAMES_FILE = 'player_names.json'
+
+# Optimistic concurrency: a mutation that lost the race to another commit is re-run on fresh state
+COMMIT_RETRIES = 200
+COMMIT_RETRY_DELAY = 0.002
+
+# Balanced deal: max gap between two players in any category, and the search time limit (s),
+# checked before every search round (see balanced_deal)
+BALANCE_TOLERANCE = 4.0
+BALANCE_BUDGET = 0.05
+
+# Write-behind: a commit lands in memory and the room is written once it has been quiet for
+# WRITE_DEBOUNCE seconds, or WRITE_MAX_DELAY seconds after its first unsaved change, so a
+# burst of clicks costs one write. Pending rooms are written at exit (and by flush()).
+# This process must be the only one changing its rooms, as the page server is; set
+# CIV_WRITE_DELAY=0 to write every commit through when several processes share them.
+WRITE_MAX_DELAY = float(os.environ.get('CIV_WRITE_DELAY', 1.0))
+WRITE_DEBOUNCE = 0.1
+
+# With CIV_API_URL set (e.g. http://127.0.0.1:8765), games are held by a running
+# `python -m civ_core.server` and the public operations below are forwarded to it
+API_URL = os.environ.get('CIV_API_URL')
+
+# Undo steps kept per room; each holds only what its action changed. The history is part of
+# the state every commit writes, so each step kept adds ~100 bytes to every write.
+HISTORY_LIMIT = 100
+# Per-seat parts of a state, diffed seat by seat
+SEATED = ('hands', 'player_flags', 'locked')
+
+# Odds tables are kept for the latest version of this many recently viewed rooms
+ODDS_ROOMS = 64
+
+_backends = {}
+_cache = RoomCache()
+_odds = OrderedDict()
+_odds_lock = threading.Lock()
+_clients = {}
+# (backend, path) -> room waiting to be written: its newest pickled state and version, the
+# version on disk it replaces and when it first/last changed
+_pending = {}
+_writes = threading.Condition()
+_writer = []
+_log = logging.getLogger(__name__)
+
+def _api():
+    from .client import ApiClient
+    if API_URL not in _clients:
+        _clients[API_URL] = ApiClient(API_URL)
+    return _clients[API_URL]
+
+def _forward(op, room, **args):
+    # Run the operation on the server and return the state it left, like the local version;
+    # sessions of this process waiting on the room hear about it as for a local commit
+    _api().call(op, room, **args)
+    state = _api().load_state(room)
+    hub.publish(check_room(room), None if state is None else state['version'])
+    return state
+
+def _path(room):
+    if STATE_BACKEND == 'sqlite':
+        return room_path(room, STATE_DB, '.db')
+    return room_path(room, STATE_FILE, '.pkl')
+
+def get_backend(room=DEFAULT_ROOM):
+    path = _path(room)
+    key = (STATE_BACKEND, path)
+    if key not in _backends:
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        _backends[key] = BACKENDS[STATE_BACKEND](path)
+    return _backends[key]
+
+def _remember(room, state):
+    # Write-through copy of the room's state for fast loads while it is hot
+    data = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+    _cache.put((STATE_BACKEND, _path(room)), state['version'], data)
+    return data
+
+@timed('state.load_state')
+def load_state(room=DEFAULT_ROOM):
+    # Hot rooms are served from memory once the (cheap) stored version confirms the copy is
+    # current; rooms with unwritten changes are served from memory without asking
+    if API_URL:
+        return _api().load_state(room)
+    backend = get_backend(room)
+    key = (STATE_BACKEND, _path(room))
+    entry = _pending.get(key)
+    if entry is not None:
+        return bind_catalog(pickle.loads(entry['data']), backend.catalog)
+    version = backend.stored_version()
+    if version is None:
+        _cache.discard(key)
+        return None
+    data = _cache.get(key, version)
+    if data is not None:
+        return bind_catalog(pickle.loads(data), backend.catalog)
+    state = backend.load()
+    if state is None:
+        return None
+    state = upgrade_state(state)
+    _remember(room, state)
+    return state
+
+@timed('state.save_state')
+def save_state(state, room=DEFAULT_ROOM):
+    # Always written at once; unwritten changes it replaces are dropped
+    _forget_pending(room)
+    get_backend(room).save(state)
+    _remember(room, state)
+    hub.publish(check_room(room), state.get('version'))
+
+def stored_version(room=DEFAULT_ROOM):
+    if API_URL:
+        return _api().version(room)
+    entry = _pending.get((STATE_BACKEND, _path(room)))
+    if entry is not None:
+        return entry['version']
+    return get_backend(room).stored_version()
+
+@timed('state.commit_state')
+def commit_state(state, expected_version, room=DEFAULT_ROOM, version=None):
+    if WRITE_MAX_DELAY > 0:
+        if not _stage(room, state, expected_version, version):
+            return False
+    elif not get_backend(room).commit(state, expected_version, version):
+        return False
+    else:
+        _remember(room, state)
+    hub.publish(check_room(room), state['version'])
+    return True
+
+@timed('state.replace_state')
+def replace_state(state, room=DEFAULT_ROOM):
+    if WRITE_MAX_DELAY > 0:
+        _stage(room, state, check=False)
+    else:
+        get_backend(room).replace(state)
+        _remember(room, state)
+    hub.publish(check_room(room), state['version'])
+    return state
+
+# Write-behind (see WRITE_MAX_DELAY). Staging is the in-memory commit: the same
+# compare-and-swap as the backends, against the newest staged version of the room. One
+# writer thread writes each room with the backend's own compare-and-swap against the
+# version it last wrote, one room write at a time and always the newest staged state, so
+# the stored version only moves forward.
+def _stage(room, state, expected_version=None, version=None, check=True):
+    # check=False stages unconditionally, like the backends' replace()
+    key = (STATE_BACKEND, _path(room))
+    dropped = None
+    with _writes:
+        entry = _pending.get(key)
+        if check and entry is not None and not entry['writing']:
+            # Another process may have written the room since this one last did: then its
+            # game wins, and the commit is refused so that the caller re-runs on it
+            stored = get_backend(room).stored_version()
+            if stored != entry['persisted']:
+                del _pending[key]
+                _cache.discard(key)
+                dropped = entry['version'], stored
+        if dropped is None:
+            current = entry['version'] if entry is not None else get_backend(room).stored_version()
+            if check and current != expected_version:
+                return False
+            if version is None:
+                version = (current or 0) + 1
+            state['version'] = version
+            now = time.monotonic()
+            if entry is None:
+                entry = _pending[key] = {'room': room, 'persisted': current, 'first': now, 'writing': False, 'retry': 0}
+            entry.update(data=_remember(room, state), version=version, last=now)
+            _writes.notify_all()
+    if dropped is not None:
+        _dropped(room, *dropped)
+        return False
+    _start_writer()
+    return True
+
+def _dropped(room, version, stored):
+    # The changes staged for `room` up to `version` lost to another process's commit. The
+    # stored game may carry the same version number as the dropped one, so watchers are
+    # woken with None first and then sent to the stored version.
+    _log.warning('room %r changed in storage (version %s), dropping unsaved changes up to version %s',
+                 room, stored, version)
+    with _odds_lock:
+        _odds.pop((STATE_BACKEND, _path(room)), None)
+    topic = check_room(room)
+    hub.publish(topic, None)
+    hub.publish(topic, stored)
+
+def _due(entry):
+    return max(min(entry['last'] + WRITE_DEBOUNCE, entry['first'] + WRITE_MAX_DELAY), entry['retry'])
+
+def _start_writer():
+    with _writes:
+        if _writer:
+            return
+        _writer.append(threading.Thread(target=_write_behind, name='civ-write-behind', daemon=True))
+    atexit.register(flush)
+    _writer[0].start()
+
+def _write_behind():
+    while True:
+        with _writes:
+            while True:
+                waiting = [(_due(entry), key) for key, entry in _pending.items() if not entry['writing']]
+                now = time.monotonic()
+                ready = [key for due, key in waiting if due <= now]
+                if ready:
+                    break
+                _writes.wait(min(due for due, _ in waiting) - now if waiting else None)
+        for key in ready:
+            try:
+                _write_pending(key)
+            except Exception:
+                # Still pending; retried after WRITE_MAX_DELAY and by flush()
+                pass
+
+def _write_pending(key):
+    # Write the newest staged state of one room; False if there was nothing to write
+    with _writes:
+        while key in _pending and _pending[key]['writing']:
+            _writes.wait()
+        entry = _pending.get(key)
+        if entry is None:
+            return False
+        entry['writing'] = True
+        room, data, version, persisted = entry['room'], entry['data'], entry['version'], entry['persisted']
+
+    written = None
+    try:
+        written = get_backend(room).commit(pickle.loads(data), persisted, version)
+    finally:
+        with _writes:
+            entry['writing'] = False
+            if written is None:
+                # The write failed (disk full, ...): keep the changes, try again after a while
+                entry['retry'] = time.monotonic() + WRITE_MAX_DELAY
+            elif not written or entry['version'] == version:
+                # Written, or another process committed to the room since: its game wins
+                del _pending[key]
+                if not written:
+                    _cache.discard(key)
+                    version = entry['version']
+            else:
+                # Changed while writing: the next write replaces what just landed
+                entry.update(persisted=version, first=time.monotonic())
+            _writes.notify_all()
+    if written is False:
+        _dropped(room, version, get_backend(room).stored_version())
+    return True
+
+def _forget_pending(room):
+    key = (STATE_BACKEND, _path(room))
+    with _writes:
+        while key in _pending and _pending[key]['writing']:
+            _writes.wait()
+        _pending.pop(key, None)
+
+def flush():
+    # Write every room with unwritten changes now; returns when they are on disk
+    while True:
+        with _writes:
+            keys = list(_pending)
+        if not keys:
+            return
+        for key in keys:
+            _write_pending(key)
+
+def watch_changes():
+    # Start the process-wide watcher for commits made by other processes (idempotent). Games
+    # held by a server are polled for their version there, as there are no files to watch.
+    if API_URL:
+        hub.start_watcher(stored_version)
+    else:
+        hub.start_watcher(stored_version, [_path(DEFAULT_ROOM), os.path.join(ROOMS_DIR, 'any')])
+
+@timed('state.mutate_state')
+def mutate_state(apply, room=DEFAULT_ROOM, record=True):
+    # Load -> apply -> commit, re-run on fresh state whenever another writer got in first.
+    # `apply` mutates the state in place and returns False when there is nothing to save.
+    # With `record`, the way back goes onto the undo history (see _push).
+    for attempt in range(COMMIT_RETRIES):
+        state = load_state(room)
+        if not state:
+            return None
+        expected = state.get('version', 0)
+        if apply_mutation(state, apply, record) is False:
+            return state
+        if commit_state(state, expected, room):
+            return state
+        time.sleep(random.uniform(0, COMMIT_RETRY_DELAY * min(attempt + 1, 10)))
+    raise StateConflictError(f'gave up after {COMMIT_RETRIES} conflicting commits')
+
+def apply_mutation(state, apply, record=True):
+    # The in-memory half of a mutation: run `apply` and, with `record`, put the way back on
+    # the undo history. False when there was nothing to change.
+    before = _view(state) if record else None
+    if apply(state) is False:
+        return False
+    if record:
+        _push(state, before)
+    return True
+
+def _names_file(room):
+    return room_path(room, PLAYER_NAMES_FILE, '.names.json')
+
+def save_player_names(names, room=DEFAULT_ROOM):
+    try:
+        with open(_names_file(room), 'w', encoding='utf-8') as f:
+            json.dump(names, f, ensure_ascii=False)
+    except Exception:
+        pass
+
+def load_saved_player_names(room=DEFAULT_ROOM):
+    if os.path.exists(_names_file(room)):
+        try:
+            with open(_names_file(room), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception:
+            return None
+    return None
+
+def new_seed():
+    # 128 bits of OS entropy, drawn once per game rather than once per card
+    return np.random.SeedSequence().entropy
+
+def build_state(players, balanced=False, seed=None, deal_rounds=None, catalog=None):
+    # A fresh game derived from `seed` alone: every random choice of the game, now and in
+    # later actions, comes from the one Generator kept in state['rng'].
+    seed = new_seed() if seed is None else int(seed)
+    rng = np.random.default_rng(seed)
+    setup = {'players': list(players), 'balanced': balanced, 'deal_rounds': deal_rounds}
+
+    # Load initial data from the compiled catalog cache (rebuilt when the xlsx changes)
+    # Every deck is shuffled once here; later draws just advance its cursor
+    catalog = load_catalog() if catalog is None else catalog
+    decks = make_decks(catalog, rng)
+    df1, df2, df3, df4, df5, df6 = [decks[name] for name in DECK_NAMES]
+    
+    # Shuffle players
+    players = shuffle_slice(list(players), rng) # Copy to avoid side effects
+    
+    # Generate initial tables (hands are kept as catalog rows, see Tables)
+    tables = Tables(catalog)
+    player_flags = {} # p1, p2, etc.
+    locked = {}
+    
+    # Balanced mode searches (within BALANCE_BUDGET seconds) for hands with close category totals.
+    # The number of search rounds goes into the setup so a replay repeats the same search.
+    dealt = None
+    if balanced:
+        dealt, setup['deal_rounds'] = balanced_deal(decks, len(players), BALANCE_TOLERANCE, BALANCE_BUDGET,
+                                                    rng=rng, rounds=deal_rounds)
+
+    # We need to handle up to 5 players
+    # Using index 0-4
+    for i in range(len(players)):
+        if dealt is not None:
+            tables[i] = dealt[i]
+        else:
+            tables[i] = deal_hand(df1, df2, df3, df4, df5, rng)
+        player_flags[i] = False
+        locked[i] = False
+        
+    # Random event (a catalog row)
+    df6_sample = random_event(df6, rng)
+    
+    # Game Info; the seating plan follows from the player order and is drawn by the page
+    map_maker = int(rng.integers(len(players)))
+    first_player = int(rng.integers(len(players)))
+    
+    state = {
+        'players': players,
+        'decks': decks,
+        'tables': tables,
+        'player_flags': player_flags,
+        'locked': locked,
+        'random_event': df6_sample,
+        'balanced': balanced,
+        'game_info': {
+            'map_maker': map_maker,
+            'first_player': first_player
+        },
+        'seed': seed,
+        'rng': rng,
+        'setup': setup,
+        'actions': '',
+        # players x categories sums of the hands, kept current by every action
+        'totals': tables.totals(len(players)),
+    }
+    
+    return state
+
+@timed('state.initialize_state')
+def initialize_state(players, balanced=False, room=DEFAULT_ROOM, seed=None, catalog=None):
+    # Check for saved player names and override if they exist
+    saved_names = load_saved_player_names(room)
+    if saved_names:
+        players = saved_names
+
+    if API_URL:
+        return _forward('initialize', room, players=list(players), balanced=balanced, seed=seed)
+    return replace_state(build_state(players, balanced, seed, catalog=catalog), room)
+
+def _record(state, action):
+    # One JSON action per line: the log is saved with every commit, and a single string
+    # pickles in microseconds however long the game runs.
+    # Games saved before seeding have no log (None) and cannot be replayed.
+    if state.get('actions') is not None:
+        state['actions'] += json.dumps(action, ensure_ascii=False) + '\n'
+
+def _reroll(state, player_index):
+    # Prevent reroll if locked
+    if state.get('locked', {}).get(player_index, False):
+        return False
+        
+    decks = state['decks']
+    
+    # Perform reroll
+    new_table = deal_hand(decks['df1'], decks['df2'], decks['df3'], decks['df4'], decks['df5'], state['rng'])
+    
+    if new_table is None:
+        return False
+    state['tables'][player_index] = new_table
+    state['totals'][player_index] = state['tables'].hand_totals(player_index)
+    state['player_flags'][player_index] = True
+    _record(state, ('reroll', player_index))
+
+@timed('state.reroll_player')
+def reroll_player(player_index, room=DEFAULT_ROOM):
+    if API_URL:
+        return _forward('reroll', room, player=player_index)
+    return mutate_state(lambda state: _reroll(state, player_index), room)
+
+def _new_event(state):
+    state['random_event'] = random_event(state['decks']['df6'], state['rng'])
+    _record(state, ('event',))
+
+@timed('state.generate_new_event')
+def generate_new_event(room=DEFAULT_ROOM):
+    if API_URL:
+        return _forward('event', room)
+    return mutate_state(_new_event, room)
+
+def _rename(state, new_players):
+    # Update names but keep tables? 
+    # The original code re-shuffled/re-seated when names changed.
+    # "if submit_button: ... state.seating = player_seating(state.players)"
+    
+    # If the number of players changes, we might need to regenerate everything or handle it gracefully.
+    # For now, let's assume we just update the names list and seating.
+    
+    state['players'] = new_players
+    _record(state, ('rename', list(new_players)))
+    
+    # If player count changed, we might need to add/remove tables
+    # But for "renaming", usually count is same. 
+    # If count changes (add/remove player), we need to handle that.
+    
+    # Logic from web_page.py:
+    # if submit_button: ... state.players = ... state.seating = ...
+    # if remove_button: ... state.players = state.players[:-1] ...
+    
+    # We should probably regenerate tables if count increases?
+    # Original code:
+    # if "table4" not in state: ...
+    
+    current_count = len(state['tables'])
+    new_count = len(new_players)
+    
+    if new_count > current_count:
+        # Add new players
+        for i in range(current_count, new_count):
+            state['tables'][i] = deal_hand(state['decks']['df1'], state['decks']['df2'], state['decks']['df3'], state['decks']['df4'], state['decks']['df5'], state['rng'])
+            state['player_flags'][i] = False
+            if 'locked' not in state:
+                state['locked'] = {}
+            state['locked'][i] = False
+        new_totals = [state['tables'].hand_totals(i) for i in range(current_count, new_count)]
+        state['totals'] = np.vstack([state['totals'][:current_count]] + new_totals)
+    elif new_count < current_count:
+        # Remove players (just delete from dict)
+        for i in range(new_count, current_count):
+            if i in state['tables']:
+                del state['tables'][i]
+            if i in state['player_flags']:
+                del state['player_flags'][i]
+            if 'locked' in state and i in state['locked']:
+                del state['locked'][i]
+        state['totals'] = state['totals'][:new_count].copy()
+                
+    # Re-roll random roles if needed?
+    # Original code:
+    # if remove_button: ... map_maker = random... first_player = random...
+    
+    # We'll just update seating for now.
+
+@timed('state.update_player_names')
+def update_player_names(new_players, room=DEFAULT_ROOM):
+    if API_URL:
+        # The server saves the names file with its next write
+        return _forward('rename', room, players=list(new_players))
+    state = mutate_state(lambda state: _rename(state, new_players), room)
+    # Save names persistently (outside the commit, which may be re-run)
+    save_player_names(new_players, room)
+    return state
+
+def swap_game(state, fresh):
+    # Put a freshly built game in place of the one in `state`, keeping the history so the
+    # old one can be brought back (and the version, which belongs to the room)
+    kept = {key: state[key] for key in ('history', 'version') if key in state}
+    state.clear()
+    state.update(fresh)
+    state.update(kept)
+
+def _new_game(state, players, balanced, seed):
+    swap_game(state, build_state(players, balanced, seed))
+
+@timed('state.reset_game')
+def reset_game(players, balanced=False, room=DEFAULT_ROOM, seed=None):
+    # New Game is an ordinary (undoable) mutation; only a room without a game starts from scratch
+    saved_names = load_saved_player_names(room)
+    if saved_names:
+        players = saved_names
+    if API_URL:
+        return _forward('reset', room, players=list(players), balanced=balanced, seed=seed)
+    state = mutate_state(lambda state: _new_game(state, players, balanced, seed), room)
+    if state is None:
+        return initialize_state(players, balanced, room, seed)
+    return state
+
+def _lock(state, player_index, lock):
+    if 'locked' not in state:
+        state['locked'] = {}
+    state['locked'][player_index] = lock
+    _record(state, ('lock', player_index, lock))
+
+@timed('state.toggle_lock')
+def toggle_lock(player_index, lock=True, room=DEFAULT_ROOM):
+    if API_URL:
+        return _forward('lock', room, player=player_index, lock=lock)
+    return mutate_state(lambda state: _lock(state, player_index, lock), room)
+
+@timed('state.game_odds')
+def game_odds(state, room=DEFAULT_ROOM):
+    # find_odds for a loaded state, read off the running totals and computed once per
+    # (room, game, version) however many sessions are watching it. The totals are part of
+    # the stamp: a game that lost to another process's commit can share all the rest.
+    key = (STATE_BACKEND, _path(room))
+    stamp = (state.get('seed'), state.get('version'), tuple(state['players']),
+             np.asarray(state['totals'], dtype=np.float64).tobytes())
+    with _odds_lock:
+        entry = _odds.get(key)
+        if entry is not None and entry[0] == stamp:
+            _odds.move_to_end(key)
+            return entry[1]
+
+    odds = odds_tables(state['totals'], state['players'])
+    with _odds_lock:
+        _odds[key] = (stamp, odds)
+        _odds.move_to_end(key)
+        while len(_odds) > ODDS_ROOMS:
+            _odds.popitem(last=False)
+    return odds
+
+def game_key(state):
+    # The same key means the same deck permutations: build_state() shuffles them from the
+    # seed and setup alone. None for games from before seeding.
+    if state.get('seed') is None:
+        return None
+    return state['seed'], json.dumps(state.get('setup'), sort_keys=True)
+
+# Replay: a game is fully determined by its seed, its setup and the actions applied since
+ACTIONS = {
+    'reroll': _reroll,
+    'event': _new_event,
+    'rename': _rename,
+    'lock': _lock,
+}
+
+def replay_log(state):
+    # JSON-friendly record of a game, e.g. to attach to a bug report; None for unseeded games
+    if state.get('actions') is None:
+        return None
+    actions = [json.loads(line) for line in state['actions'].splitlines()]
+    return {'seed': state['seed'], 'setup': state['setup'], 'actions': actions}
+
+def replay(log):
+    # Rebuild a game from replay_log() output without touching the stored state
+    setup = log['setup']
+    state = build_state(setup['players'], setup['balanced'], log['seed'], setup.get('deal_rounds'))
+    for name, *args in log['actions']:
+        ACTIONS[name](state, *args)
+    return state
+
+# Undo/redo. The history is a pair of stacks of inverse diffs kept in the state itself, so
+# every session of a room shares it. A diff holds only the fields (and seats and deck
+# cursors) an action changed; deck permutations are never copied, since a game's decks
+# can be rebuilt from its seed and setup.
+def _view(state):
+    # What undo puts back, as plain JSON values
+    return {
+        'game': [state.get('seed'), state.get('setup'), state.get('balanced', False)],
+        'players': list(state['players']),
+        'hands': {i: None if rows is None else rows.tolist() for i, rows in state['tables'].hands.items()},
+        'player_flags': dict(state.get('player_flags', {})),
+        'locked': dict(state.get('locked', {})),
+        'random_event': state['random_event'],
+        'game_info': dict(state['game_info']),
+        'rng': state['rng'].bit_generator.state,
+        'actions': state.get('actions'),
+        'cursors': {name: deck.cursor for name, deck in state['decks'].items()},
+    }
+
+def _diff(now, then):
+    # The parts of view `then` that differ from view `now`; _restore() of the result on a
+    # state that looks like `now` makes it look like `then`
+    diff = {}
+    for key, value in then.items():
+        old = now[key]
+        if key in SEATED:
+            changed = [[i] if i not in value else [i, value[i]]
+                       for i in sorted(set(old) | set(value)) if i not in value or old.get(i) != value[i]]
+            if changed:
+                diff[key] = changed
+        elif key == 'cursors':
+            changed = {name: cursor for name, cursor in value.items() if old.get(name) != cursor}
+            if changed:
+                diff[key] = changed
+        elif key == 'actions' and isinstance(old, str) and isinstance(value, str):
+            # The log only grows within a game: keep a prefix, append a tail
+            keep = len(value) if old.startswith(value) else len(os.path.commonprefix([old, value]))
+            if keep != len(old) or keep != len(value):
+                diff[key] = [keep, value[keep:]]
+        elif value != old:
+            diff[key] = value
+    return diff
+
+def _restore(state, diff):
+    cursors = {name: deck.cursor for name, deck in state['decks'].items()}
+    cursors.update(diff.get('cursors', {}))
+    if 'game' in diff:
+        # Back to another game: rebuild its decks from the seed, then move the cursors
+        seed, setup, balanced = diff['game']
+        catalog = state['decks']['df1'].catalog
+        state['decks'] = build_state(setup['players'], setup['balanced'], seed, setup['deal_rounds'], catalog)['decks']
+        state.update(seed=seed, setup=setup, balanced=balanced)
+    for name, cursor in cursors.items():
+        state['decks'][name].seek(cursor)
+
+    for key in SEATED:
+        target = state['tables'] if key == 'hands' else state.setdefault(key, {})
+        for i, *value in diff.get(key, []):
+            if value:
+                target[i] = value[0]
+            else:
+                target.pop(i, None)
+    for key in ('players', 'random_event', 'game_info'):
+        if key in diff:
+            state[key] = diff[key]
+    if 'rng' in diff:
+        state['rng'].bit_generator.state = diff['rng']
+    if 'actions' in diff:
+        actions = diff['actions']
+        state['actions'] = state['actions'][:actions[0]] + actions[1] if isinstance(actions, list) else actions
+    state['totals'] = state['tables'].totals(len(state['players']))
+
+def _push(state, before):
+    history = state.setdefault('history', {'undo': [], 'redo': []})
+    inverse = _diff(_view(state), before)
+    if 'game' in inverse and inverse['game'][0] is None:
+        # A game from before seeding cannot be rebuilt, so there is no way back past here
+        history['undo'].clear()
+    else:
+        history['undo'].append(inverse)
+        del history['undo'][:-HISTORY_LIMIT]
+    history['redo'].clear()
+
+def _step(state, source, target):
+    history = state.get('history')
+    if not history or not history[source]:
+        return False
+    now = _view(state)
+    _restore(state, history[source].pop())
+    history[target].append(_diff(_view(state), now))
+    # Games saved with a longer history shrink to the limit as they are played
+    del history[target][:-HISTORY_LIMIT]
+
+def can_undo(state):
+    return bool(state.get('history', {}).get('undo'))
+
+def can_redo(state):
+    return bool(state.get('history', {}).get('redo'))
+
+@timed('state.undo')
+def undo(room=DEFAULT_ROOM):
+    if API_URL:
+        return _forward('undo', room)
+    return mutate_state(lambda state: _step(state, 'undo', 'redo'), room, record=False)
+
+@timed('state.redo')
+def redo(room=DEFAULT_ROOM):
+    if API_URL:
+        return _forward('redo', room)
+    return mutate_state(lambda state: _step(state, 'redo', 'undo'), room, record=False)
+
+# Every game operation by name, for callers that keep games in memory (civ_core.server):
+# name -> (apply(state, *args), whether it goes on the undo history)
+OPERATIONS = {
+    'reroll': (_reroll, True),
+    'lock': (_lock, True),
+    'event': (_new_event, True),
+    'rename': (_rename, True),
+    'reset': (_new_game, True),
+    'undo': (lambda state: _step(state, 'undo', 'redo'), False),
+    'redo': (lambda state: _step(state, 'redo', 'undo'), False),
+}
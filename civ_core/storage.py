@@ -0,0 +1,504 @@
+import argparse
+import io
+import json
+import os
+import pickle
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+import numpy as np
+from .catalog import load_catalog
+from .random_generator import Deck, Tables, DECK_NAMES, HAND_DECKS, deck_from_frame, player_totals, rows_from_frame
+from .metrics import timed
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# State file layout: magic, format, state version, payload length, crc32 of the payload, payload.
+# Format 1 had no state version field; formats 1 and 2 pickle the state, format 3 uses encode_state.
+STATE_MAGIC = b'CIVS'
+STATE_FORMAT = 3
+STATE_HEADERS = {1: struct.Struct('<4sHQI'), 2: struct.Struct('<4sHQQI'), 3: struct.Struct('<4sHQQI')}
+STATE_HEADER = STATE_HEADERS[STATE_FORMAT]
+LOAD_RETRIES = 5
+LOAD_RETRY_DELAY = 0.02
+
+
+# Modules that moved into this package; older saves still refer to them by the old name
+MOVED_MODULES = {'random_generator': __package__ + '.random_generator'}
+
+
+class _StateUnpickler(pickle.Unpickler):
+
+    def find_class(self, module, name):
+        return super().find_class(MOVED_MODULES.get(module, module), name)
+
+
+def _loads(data):
+    return _StateUnpickler(io.BytesIO(data)).load()
+
+
+# encode_state payload: schema number and document length, a JSON document, then the
+# arrays it refers to (deck permutations, hands as catalog rows, totals) back to back.
+STATE_SCHEMA = 1
+STATE_PREFIX = struct.Struct('<HI')
+# Seat-indexed dicts; JSON object keys would turn the indices into strings
+SEAT_KEYS = ('player_flags', 'locked')
+# A SQLite card_table holding a hand's rows (pickled tables from older saves start with 0x80)
+ROWS_TAG = b'R'
+
+
+class StateCorruptError(Exception):
+    pass
+
+
+class StateConflictError(Exception):
+    pass
+
+
+def bind_catalog(state, catalog):
+    # Saved decks and hands do not carry the catalog; point them at the one the caller
+    # deals from (None leaves them on the workbook's)
+    if catalog is not None:
+        for deck in state['decks'].values():
+            deck.catalog = catalog
+        if isinstance(state['tables'], Tables):
+            state['tables'].catalog = catalog
+    return state
+
+
+def _plain(value):
+    # numpy scalars that end up in the state (row numbers, flags) as JSON values
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f'{type(value).__name__} does not fit the state schema')
+
+
+def encode_state(state):
+    # The state without pickle or pandas: everything but the card arrays is plain JSON.
+    # The version lives in the file header and is not part of the payload.
+    blocks, size = [], 0
+
+    def block(array):
+        nonlocal size
+        array = np.ascontiguousarray(array)
+        blocks.append(array.tobytes())
+        size += array.nbytes
+        return [array.dtype.str, list(array.shape), size - array.nbytes]
+
+    # Card arrays hold catalog rows: they are stored in the narrowest unsigned type that holds
+    # the largest row of any deck (every card dealt comes from one), which each block's
+    # reference records, e.g. one byte per card for catalogs of up to 256 rows
+    largest = max((int(deck.pool.max(initial=0)) for deck in state['decks'].values()), default=0)
+    rows_type = np.dtype(np.min_scalar_type(largest)).newbyteorder('<')
+
+    doc = {}
+    for key, value in state.items():
+        if key == 'version':
+            continue
+        if key == 'decks':
+            value = {name: [deck.tier, deck.replace, deck.cursor, block(deck.pool.astype(rows_type))]
+                     for name, deck in value.items()}
+        elif key == 'tables':
+            value = [[i, None if rows is None else block(rows.astype(rows_type))] for i, rows in value.hands.items()]
+        elif key == 'totals':
+            value = block(np.asarray(value, dtype='<f8'))
+        elif key == 'rng':
+            value = value.bit_generator.state
+        elif key in SEAT_KEYS:
+            value = list(value.items())
+        doc[key] = value
+
+    body = json.dumps(doc, ensure_ascii=False, separators=(',', ':'), default=_plain).encode('utf-8')
+    return STATE_PREFIX.pack(STATE_SCHEMA, len(body)) + body + b''.join(blocks)
+
+
+def decode_state(data, catalog=None):
+    schema, length = STATE_PREFIX.unpack_from(data)
+    if schema != STATE_SCHEMA:
+        raise StateCorruptError(f'unknown state schema {schema}')
+    doc = json.loads(bytes(data[STATE_PREFIX.size:STATE_PREFIX.size + length]))
+    start = STATE_PREFIX.size + length
+
+    def array(ref):
+        dtype, shape, offset = ref
+        count = int(np.prod(shape))
+        return np.frombuffer(data, dtype, count, start + offset).reshape(shape).copy()
+
+    state = {}
+    for key, value in doc.items():
+        if key == 'decks':
+            value = {name: Deck.restore(catalog, tier, replace, array(pool).astype(np.int64), cursor)
+                     for name, (tier, replace, cursor, pool) in value.items()}
+        elif key == 'tables':
+            value = Tables(catalog, {i: None if rows is None else array(rows).astype(np.int64) for i, rows in value})
+        elif key == 'totals':
+            value = array(value).astype(np.float64)
+        elif key == 'rng':
+            rng = np.random.Generator(getattr(np.random, value['bit_generator'])())
+            rng.bit_generator.state = value
+            value = rng
+        elif key in SEAT_KEYS:
+            value = {i: flag for i, flag in value}
+        state[key] = value
+    return state
+
+
+def upgrade_state(state):
+    # Saves from before versioned commits count as version 0
+    state.setdefault('version', 0)
+
+    # Saves from before seeded games: keep playing on an unseeded generator, without a replay log
+    if 'rng' not in state:
+        state.update(seed=None, rng=np.random.default_rng(), setup=None, actions=None)
+
+    # Saves from before compact tables kept each hand and the event as a DataFrame, and the
+    # seating plan in game_info; the hands and the event become catalog rows
+    state['game_info'].pop('seating', None)
+    tables = state['tables']
+    if not isinstance(tables, Tables):
+        catalog = load_catalog()
+        hand_tiers = range(1, len(HAND_DECKS) + 1)
+        state['tables'] = Tables(catalog, {
+            i: rows_from_frame(catalog, table, hand_tiers) if hasattr(table, 'columns') else table
+            for i, table in tables.items()
+        })
+    if hasattr(state['random_event'], 'columns'):
+        state['random_event'] = int(rows_from_frame(load_catalog(), state['random_event'], [len(DECK_NAMES)])[0])
+
+    # Saves from before the running totals: sum the hands once
+    if 'totals' not in state:
+        state['totals'] = player_totals([state['tables'].get(i) for i in range(len(state['players']))])
+
+    # Older saves kept the remaining cards of each deck as a DataFrame
+    decks = state['decks']
+    if all(isinstance(decks[name], Deck) for name in DECK_NAMES):
+        return state
+    catalog = load_catalog()
+    for tier, name in enumerate(DECK_NAMES, start=1):
+        if not isinstance(decks[name], Deck):
+            decks[name] = deck_from_frame(catalog, decks[name], tier, replace=name in ('df4', 'df6'))
+    return state
+
+
+class PickleBackend:
+    # The whole state pickled into one file, rewritten on every commit
+
+    def __init__(self, path, catalog=None):
+        self.path = path
+        # Catalog the decks are bound to on load; the workbook's unless a caller deals from another one
+        self.catalog = catalog
+
+    def _encode(self, state):
+        payload = encode_state(state)
+        return STATE_HEADER.pack(STATE_MAGIC, STATE_FORMAT, state.get('version', 0), len(payload), zlib.crc32(payload)) + payload
+
+    @staticmethod
+    def _read_header(data):
+        if len(data) < 6:
+            raise StateCorruptError('truncated header')
+        fmt = struct.unpack_from('<H', data, 4)[0]
+        if fmt not in STATE_HEADERS:
+            raise StateCorruptError(f'unknown state format {fmt}')
+        header = STATE_HEADERS[fmt]
+        if len(data) < header.size:
+            raise StateCorruptError('truncated header')
+        fields = header.unpack_from(data)
+        version = fields[2] if fmt >= 2 else None
+        return header.size, version, fields[-2], fields[-1]
+
+    def _decode(self, data):
+        if not data.startswith(STATE_MAGIC):
+            # Saves from before the header was introduced are a bare pickle
+            return _loads(data)
+        size, version, length, crc = self._read_header(data)
+        payload = data[size:]
+        if len(payload) != length or zlib.crc32(payload) != crc:
+            raise StateCorruptError('checksum mismatch')
+        fmt = struct.unpack_from('<H', data, 4)[0]
+        state = decode_state(payload, self.catalog) if fmt >= 3 else _loads(payload)
+        if version is not None:
+            state['version'] = version
+        return state
+
+    @timed('storage.pickle.load')
+    def load(self):
+        # A failed checksum means we raced a writer (or the disk is lying): retry
+        # rather than reporting "no game", which would make the page deal a new one.
+        for attempt in range(LOAD_RETRIES):
+            try:
+                with open(self.path, 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                return None
+            try:
+                return bind_catalog(self._decode(data), self.catalog)
+            except (StateCorruptError, pickle.UnpicklingError, EOFError, struct.error, ValueError):
+                time.sleep(LOAD_RETRY_DELAY * (attempt + 1))
+        raise StateCorruptError(f'{self.path} failed its checksum {LOAD_RETRIES} times')
+
+    @timed('storage.pickle.save')
+    def save(self, state):
+        # Write a temp file next to the target, fsync it and rename it over the old
+        # state, so readers only ever see the previous or the new complete file.
+        data = self._encode(state)
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(prefix='.game_state.', suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        if hasattr(os, 'O_DIRECTORY'):
+            # Make the rename itself durable (POSIX only)
+            dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+    @timed('storage.pickle.stored_version')
+    def stored_version(self):
+        # Version of the state on disk, read from the header alone; None when there is no game
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read(max(h.size for h in STATE_HEADERS.values()))
+        except FileNotFoundError:
+            return None
+        if data.startswith(STATE_MAGIC):
+            version = self._read_header(data)[1]
+            if version is not None:
+                return version
+        state = self.load()
+        return None if state is None else state.get('version', 0)
+
+    @contextmanager
+    def _lock(self):
+        # Advisory lock held only around the version check and the write of a commit
+        with open(self.path + '.lock', 'a+b') as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+    @timed('storage.pickle.commit')
+    def commit(self, state, expected_version, version=None):
+        # Compare-and-swap: write `state` only if nobody committed since we loaded `expected_version`.
+        # The new version is expected + 1 unless the caller numbered several changes itself.
+        with self._lock():
+            if self.stored_version() != expected_version:
+                return False
+            state['version'] = (expected_version or 0) + 1 if version is None else version
+            self.save(state)
+        return True
+
+    @timed('storage.pickle.replace')
+    def replace(self, state):
+        # Unconditional commit (new game); still bumps the version so in-flight mutations of the old game retry
+        with self._lock():
+            state['version'] = (self.stored_version() or 0) + 1
+            self.save(state)
+        return state
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value BLOB);
+CREATE TABLE IF NOT EXISTS decks (name TEXT PRIMARY KEY, tier INTEGER NOT NULL, replace INTEGER NOT NULL, rows BLOB NOT NULL,
+                                  cursor INTEGER);
+CREATE TABLE IF NOT EXISTS players (idx INTEGER PRIMARY KEY, card_table BLOB, flag INTEGER, locked INTEGER);
+"""
+
+
+class SqliteBackend:
+    # One row per deck, per player seat and per remaining state key, in a WAL-mode database.
+    # A commit only rewrites the rows whose content changed, and readers never block the writer.
+
+    def __init__(self, path, catalog=None):
+        self.path = path
+        # Catalog the decks are rebuilt on; the workbook's unless a caller deals from another one
+        self.catalog = catalog
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(SCHEMA)
+            if 'cursor' not in [column[1] for column in conn.execute('PRAGMA table_info(decks)')]:
+                # Databases from before the cursor column stored only the remaining cards
+                conn.execute('ALTER TABLE decks ADD COLUMN cursor INTEGER')
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self, mode=''):
+        conn = self._connect()
+        conn.execute(f'BEGIN {mode}')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    @staticmethod
+    def _version(conn):
+        row = conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        return None if row is None else int(row[0])
+
+    @timed('storage.sqlite.load')
+    def load(self):
+        with self._transaction() as conn:
+            version = self._version(conn)
+            if version is None:
+                return None
+            meta = conn.execute("SELECT key, value FROM meta WHERE key != 'version'").fetchall()
+            decks = conn.execute('SELECT name, tier, replace, rows, cursor FROM decks').fetchall()
+            players = conn.execute('SELECT idx, card_table, flag, locked FROM players ORDER BY idx').fetchall()
+
+        state = {key: _loads(value) for key, value in meta}
+        state['version'] = version
+
+        # Each deck is stored as its whole permutation and cursor, so undo can move the cursor
+        # back; rows without a cursor (older databases) hold only the remaining cards
+        catalog = load_catalog() if self.catalog is None else self.catalog
+        state['decks'] = {
+            name: Deck.restore(catalog, tier, bool(replace), np.frombuffer(rows, dtype='<i8'), cursor or 0)
+            for name, tier, replace, rows, cursor in decks
+        }
+        if any(cursor is None for *deck, cursor in decks) and 'history' in state:
+            # Undo steps hold absolute cursors, which those decks no longer have
+            state['history'] = {'undo': [], 'redo': []}
+        hands, state['player_flags'], state['locked'] = {}, {}, {}
+        for idx, card_table, flag, locked in players:
+            if card_table is not None and card_table.startswith(ROWS_TAG):
+                hands[idx] = np.frombuffer(card_table, dtype='<i8', offset=len(ROWS_TAG)).copy() if len(card_table) > 1 else None
+            elif card_table is not None:
+                # Pickled DataFrame from an older save; upgrade_state turns it into rows
+                hands[idx] = _loads(card_table)
+            if flag is not None:
+                state['player_flags'][idx] = bool(flag)
+            if locked is not None:
+                state['locked'][idx] = bool(locked)
+        legacy = any(hasattr(table, 'columns') for table in hands.values())
+        state['tables'] = hands if legacy else Tables(catalog, hands)
+
+        return state
+
+    def _write(self, conn, state):
+        # Upserts skip rows whose content is unchanged, so a reroll touches a handful of rows
+        for key, value in state.items():
+            if key in ('version', 'decks', 'tables', 'player_flags', 'locked'):
+                continue
+            conn.execute(
+                'INSERT INTO meta (key, value) VALUES (?, ?) '
+                'ON CONFLICT(key) DO UPDATE SET value = excluded.value WHERE meta.value IS NOT excluded.value',
+                (key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)))
+        conn.execute(
+            "DELETE FROM meta WHERE key != 'version' AND key NOT IN (%s)" % ','.join('?' * len(state)),
+            list(state))
+
+        for name, deck in state['decks'].items():
+            # The permutation only changes with a new game; a draw rewrites just the cursor
+            rows = deck.pool.astype('<i8').tobytes()
+            conn.execute(
+                'INSERT INTO decks (name, tier, replace, rows, cursor) VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT(name) DO UPDATE SET tier = excluded.tier, replace = excluded.replace, rows = excluded.rows, '
+                'cursor = excluded.cursor WHERE decks.rows IS NOT excluded.rows OR decks.cursor IS NOT excluded.cursor',
+                (name, deck.tier, int(deck.replace), rows, deck.cursor))
+
+        tables, flags, locked = state['tables'], state.get('player_flags', {}), state.get('locked', {})
+        seats = sorted(set(tables) | set(flags) | set(locked))
+        for idx in seats:
+            card_table = None
+            if idx in tables:
+                rows = tables.hands[idx]
+                card_table = ROWS_TAG + (b'' if rows is None else rows.astype('<i8').tobytes())
+            flag = int(flags[idx]) if idx in flags else None
+            lock = int(locked[idx]) if idx in locked else None
+            conn.execute(
+                'INSERT INTO players (idx, card_table, flag, locked) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(idx) DO UPDATE SET card_table = excluded.card_table, flag = excluded.flag, locked = excluded.locked '
+                'WHERE players.card_table IS NOT excluded.card_table OR players.flag IS NOT excluded.flag '
+                'OR players.locked IS NOT excluded.locked',
+                (idx, card_table, flag, lock))
+        conn.execute('DELETE FROM players WHERE idx NOT IN (%s)' % ','.join('?' * len(seats)), seats)
+
+        conn.execute(
+            "INSERT INTO meta (key, value) VALUES ('version', ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (state.get('version', 0),))
+
+    @timed('storage.sqlite.save')
+    def save(self, state):
+        with self._transaction('IMMEDIATE') as conn:
+            self._write(conn, state)
+
+    @timed('storage.sqlite.stored_version')
+    def stored_version(self):
+        return self._version(self._connect())
+
+    @timed('storage.sqlite.commit')
+    def commit(self, state, expected_version, version=None):
+        # BEGIN IMMEDIATE takes the write lock, so the version check and the write are atomic
+        with self._transaction('IMMEDIATE') as conn:
+            if self._version(conn) != expected_version:
+                return False
+            state['version'] = (expected_version or 0) + 1 if version is None else version
+            self._write(conn, state)
+        return True
+
+    @timed('storage.sqlite.replace')
+    def replace(self, state):
+        with self._transaction('IMMEDIATE') as conn:
+            state['version'] = (self._version(conn) or 0) + 1
+            self._write(conn, state)
+        return state
+
+
+BACKENDS = {'pickle': PickleBackend, 'sqlite': SqliteBackend}
+
+
+def migrate(pickle_path, db_path):
+    # Import an existing game_state.pkl into a SQLite database, keeping its version
+    state = PickleBackend(pickle_path).load()
+    if state is None:
+        return None
+    state = upgrade_state(state)
+    state.setdefault('version', 0)
+    SqliteBackend(db_path).save(state)
+    return state
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Import a pickled game state into SQLite')
+    parser.add_argument('pickle_path', nargs='?', default='game_state.pkl')
+    parser.add_argument('db_path', nargs='?', default='game_state.db')
+    args = parser.parse_args()
+
+    migrated = migrate(args.pickle_path, args.db_path)
+    print('nothing to migrate' if migrated is None else f"migrated version {migrated['version']} to {args.db_path}")
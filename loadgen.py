@@ -0,0 +1,218 @@
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+from civ_core.server import frame, read_frame
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+# Files a spawned server needs next to it; the cache only saves it parsing the workbook
+DATA_FILES = ['Civ_bonuses.xlsx', 'Civ_bonuses.cache.npz']
+# What a client does after each think time: mostly looking at the game, sometimes changing it
+MIX = {'get': 0.6, 'reroll': 0.2, 'lock': 0.1, 'event': 0.1}
+
+
+def spawn_server(port, flush_interval):
+    # A server in a scratch directory, so the load never touches the real game files
+    directory = tempfile.mkdtemp(prefix='civ-loadgen-')
+    for name in DATA_FILES:
+        if os.path.exists(os.path.join(ROOT, name)):
+            shutil.copy(os.path.join(ROOT, name), directory)
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    env.pop('CIV_API_URL', None)
+    process = subprocess.Popen([sys.executable, '-m', 'civ_core.server', '--port', str(port),
+                                '--flush-interval', str(flush_interval)],
+                               cwd=directory, env=env, stdout=subprocess.DEVNULL)
+    return process, directory
+
+
+class Connection:
+    # One client's keep-alive HTTP connection, or a WebSocket with --websocket
+
+    def __init__(self, host, port, websocket):
+        self.host, self.port, self.websocket = host, port, websocket
+        self.next_id = 0
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        if self.websocket:
+            key = base64.b64encode(os.urandom(16)).decode()
+            self.writer.write((f'GET / HTTP/1.1\r\nHost: {self.host}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                               f'Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n').encode())
+            head = await self.reader.readuntil(b'\r\n\r\n')
+            if b' 101 ' not in head.split(b'\r\n')[0]:
+                raise ConnectionError('WebSocket upgrade refused')
+
+    async def request(self, room, op, args=None):
+        if self.websocket:
+            return await self._message(room, op, args)
+        if op == 'get':
+            method, path, body = 'GET', f'/rooms/{room}', b''
+        else:
+            method, path, body = 'POST', f'/rooms/{room}/{op}', json.dumps(args or {}).encode()
+        self.writer.write((f'{method} {path} HTTP/1.1\r\nHost: {self.host}\r\n'
+                           f'Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n').encode() + body)
+        head = await self.reader.readuntil(b'\r\n\r\n')
+        length = 0
+        for line in head.decode('latin-1').split('\r\n')[1:]:
+            name, _, value = line.partition(':')
+            if name.strip().lower() == 'content-length':
+                length = int(value)
+        return json.loads(await self.reader.readexactly(length))
+
+    async def _message(self, room, op, args):
+        self.next_id += 1
+        message = {'id': self.next_id, 'room': room, 'op': op, 'args': args or {}}
+        self.writer.write(frame(1, json.dumps(message).encode(), mask=True))
+        while True:
+            opcode, data = await read_frame(self.reader)
+            if opcode != 1:
+                continue
+            reply = json.loads(data)
+            # Change pushes from other clients of the room arrive in between
+            if reply.get('id') == self.next_id:
+                return reply
+
+    def close(self):
+        self.writer.close()
+
+
+async def client(host, port, room, players, deadline, think, websocket, seed, samples, errors):
+    # One seat at one table: the client only uses `room`, so WebSocket pushes come from its own game
+    rnd = random.Random(seed)
+    conn = Connection(host, port, websocket)
+    await conn.open()
+    ops, weights = list(MIX), list(MIX.values())
+    try:
+        while True:
+            await asyncio.sleep(rnd.expovariate(1 / think) if think > 0 else 0)
+            if time.perf_counter() >= deadline:
+                break
+            op = rnd.choices(ops, weights)[0]
+            args = {'player': rnd.randrange(players)} if op in ('reroll', 'lock') else None
+            if op == 'lock':
+                args['lock'] = rnd.random() < 0.3
+
+            t0 = time.perf_counter()
+            reply = await conn.request(room, op, args)
+            samples.append((op, time.perf_counter() - t0))
+            if 'error' in reply:
+                errors.append(reply['error'])
+            elif op == 'reroll' and not reply['changed'] and not reply['state']['locked'][args['player']]:
+                # The decks ran out: deal this room a new game, like a table pressing New Game
+                t0 = time.perf_counter()
+                reply = await conn.request(room, 'reset', {'players': [f'P{i}' for i in range(players)]})
+                samples.append(('reset', time.perf_counter() - t0))
+    finally:
+        conn.close()
+
+
+async def run(host, port, clients=200, duration=10.0, think=0.5, rooms=10, players=4, websocket=False, seed=0):
+    names = [f'load-{i}' for i in range(rooms)]
+    setup = Connection(host, port, False)
+    await setup.open()
+    for i, room in enumerate(names):
+        await setup.request(room, 'initialize', {'players': [f'P{k}' for k in range(players)], 'seed': seed + i})
+    setup.close()
+
+    samples, errors = [], []
+    started = time.perf_counter()
+    deadline = started + duration
+    await asyncio.gather(*[client(host, port, names[i % rooms], players, deadline, think, websocket, seed * 100_003 + i,
+                                  samples, errors) for i in range(clients)])
+    elapsed = time.perf_counter() - started
+
+    def stats(times):
+        times = np.array(times) * 1000
+        return {
+            'requests': len(times),
+            'p50_ms': float(np.percentile(times, 50)),
+            'p95_ms': float(np.percentile(times, 95)),
+            'p99_ms': float(np.percentile(times, 99)),
+            'max_ms': float(times.max()),
+        }
+
+    by_op = {}
+    for op, seconds in samples:
+        by_op.setdefault(op, []).append(seconds)
+    return {
+        'clients': clients,
+        'duration_s': elapsed,
+        'think_s': think,
+        'rooms': rooms,
+        'transport': 'websocket' if websocket else 'http',
+        'throughput_rps': len(samples) / elapsed,
+        'errors': len(errors),
+        'overall': stats([seconds for _, seconds in samples]),
+        'ops': {op: stats(times) for op, times in sorted(by_op.items())},
+    }
+
+
+async def _wait_ready(host, port, timeout=30):
+    stop = time.perf_counter() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection(host, port)
+            writer.close()
+            return
+        except OSError:
+            if time.perf_counter() > stop:
+                raise
+            await asyncio.sleep(0.1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load generator for the game API server (python -m civ_core.server)')
+    parser.add_argument('--url', default=None, help='server to load, e.g. http://127.0.0.1:8765; '
+                                                    'by default a server is started in a scratch directory')
+    parser.add_argument('--port', type=int, default=8799, help='port of the started server')
+    parser.add_argument('--clients', type=int, default=200, help='concurrent connections')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of load')
+    parser.add_argument('--think', type=float, default=0.5, help='mean pause between a client\'s requests (s)')
+    parser.add_argument('--rooms', type=int, default=10)
+    parser.add_argument('--players', type=int, default=4)
+    parser.add_argument('--websocket', action='store_true', help='talk over WebSockets instead of HTTP')
+    parser.add_argument('--flush-interval', type=float, default=0.5, help='of the started server')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--p99-ms', type=float, default=10.0, help='exit 1 when the overall p99 is above this')
+    parser.add_argument('--json', default=None, help='write the report to this file')
+    args = parser.parse_args()
+
+    process = directory = None
+    if args.url:
+        target = args.url.split('://', 1)[-1].rstrip('/')
+        host, _, port = target.partition(':')
+        port = int(port or 80)
+    else:
+        host, port = '127.0.0.1', args.port
+        process, directory = spawn_server(port, args.flush_interval)
+
+    try:
+        asyncio.run(_wait_ready(host, port))
+        report = asyncio.run(run(host, port, args.clients, args.duration, args.think, args.rooms, args.players,
+                                 args.websocket, args.seed))
+    finally:
+        if process is not None:
+            # SIGTERM makes the server write its rooms before it exits
+            process.terminate()
+            process.wait()
+            shutil.rmtree(directory, ignore_errors=True)
+
+    print(f"{report['clients']} {report['transport']} clients, {report['rooms']} rooms, think {report['think_s']} s: "
+          f"{report['throughput_rps']:.0f} requests/s, {report['errors']} errors")
+    for name, result in [('overall', report['overall'])] + list(report['ops'].items()):
+        print(f"{name:<8} {result['requests']:>7} requests  p50 {result['p50_ms']:>7.2f} ms  p95 {result['p95_ms']:>7.2f} ms"
+              f"  p99 {result['p99_ms']:>7.2f} ms  max {result['max_ms']:>7.2f} ms")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+    sys.exit(1 if report['overall']['p99_ms'] > args.p99_ms or report['errors'] else 0)
@@ -1,5 +1,4 @@
-from web_page import create_web_page
-from read_file import parse_sheet
+from web_page import create_web_page, parse_sheet
 
 if __name__ == "__main__":
     # Specify players
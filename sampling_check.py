@@ -0,0 +1,140 @@
+import argparse
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+from civ_core.catalog import load_catalog, COLUMNS, WEIGHT_COLUMN
+from civ_core.random_generator import AliasTable, Deck, deal_batch, hand_distribution, make_decks
+
+# Standard normal quantile of the one-sided test level, and the level itself
+Z = 3.719
+ALPHA = 1e-4
+
+
+def chi_square(observed, expected):
+    # Pearson's statistic against the Wilson-Hilferty approximation of the chi-square
+    # critical value. Cells that can never come up must not come up.
+    observed, expected = np.asarray(observed, dtype=np.float64), np.asarray(expected, dtype=np.float64)
+    impossible = expected == 0
+    stat = np.square(observed[~impossible] - expected[~impossible]) / expected[~impossible]
+    dof = max(int((~impossible).sum()) - 1, 1)
+    critical = dof * (1 - 2 / (9 * dof) + Z * np.sqrt(2 / (9 * dof))) ** 3
+    return float(stat.sum()), dof, critical, bool(stat.sum() <= critical and not observed[impossible].any())
+
+
+def weighted_catalog(weights, tiers=(1,)):
+    # A copy of the same cards per tier, with the given weights and distinct culture scores
+    n = len(weights)
+    df = pd.DataFrame({
+        'tier': np.repeat(tiers, n),
+        'bonus': [f'card {i}' for i in range(n * len(tiers))],
+        'cul': np.tile(np.arange(n, dtype=np.float64), len(tiers)),
+        'eco': 1.0, 'war': 0.0, 'tech': 0.0,
+    })[COLUMNS]
+    df[WEIGHT_COLUMN] = np.tile(weights, len(tiers))
+    return df
+
+
+def pair_probabilities(weights):
+    # P(first draw i, second draw j) when drawing by weight without replacement
+    w = np.asarray(weights, dtype=np.float64)
+    total = w.sum()
+    rest = np.where(total - w > 0, total - w, np.inf)
+    probs = (w / total)[:, None] * w[None, :] / rest[:, None]
+    np.fill_diagonal(probs, 0)
+    return probs
+
+
+def checks(draws, seed):
+    rng = np.random.default_rng(seed)
+    weights = np.array([5.0, 1.0, 0.0, 2.5, 0.5, 1.0, 10.0, 0.25])
+    target = weights / weights.sum()
+    catalog = weighted_catalog(weights)
+    results = []
+
+    table = AliasTable(weights)
+    results.append(('alias sample', chi_square(np.bincount(table.sample(rng, draws), minlength=len(weights)),
+                                               target * draws)))
+    single = draws // 10
+    results.append(('alias draw', chi_square(np.bincount([table.draw(rng) for _ in range(single)],
+                                                         minlength=len(weights)), target * single)))
+
+    # A deck with replacement draws from the alias table over its pool
+    deck = Deck(catalog, 1, replace=True)
+    counts = np.bincount([deck.draw(rng) for _ in range(single)], minlength=len(catalog))[:len(weights)]
+    results.append(('deck with replacement', chi_square(counts, target * single)))
+
+    # Without replacement: the first two cards of fresh decks, against the sequential probabilities
+    games = draws // 20
+    pairs = np.zeros((len(weights), len(weights)))
+    for _ in range(games):
+        deck = Deck(catalog, 1, rng=rng)
+        pairs[deck.draw(), deck.draw()] += 1
+    results.append(('deck without replacement, first two draws', chi_square(pairs.ravel(),
+                                                                             pair_probabilities(weights).ravel() * games)))
+
+    # After a balanced deal took specific cards, the next draw is by the weight of what is left
+    counts = np.zeros(len(weights))
+    for _ in range(games):
+        deck = Deck(catalog, 1, rng=rng)
+        deck.take([0, 6])
+        counts[deck.draw()] += 1
+    rest = weights.copy()
+    rest[[0, 6]] = 0
+    results.append(('deck after take', chi_square(counts, rest / rest.sum() * games)))
+
+    # deal_batch: the two players' cards in draw order, and a column drawn with replacement
+    rows = np.arange(len(weights))
+    hands = deal_batch([rows, rows], 2, draws // 4, rng, replace=(False, True), weights=[weights, weights])
+    pairs = np.bincount(hands[:, 0, 0] * len(weights) + hands[:, 1, 0], minlength=len(weights) ** 2)
+    results.append(('deal_batch without replacement', chi_square(pairs, pair_probabilities(weights).ravel() * (draws // 4))))
+    results.append(('deal_batch with replacement', chi_square(np.bincount(hands[:, :, 1].ravel(), minlength=len(weights)),
+                                                              target * (draws // 2))))
+    return results
+
+
+def exact_checks():
+    # Things that hold exactly: cards weighted 0 are left out, the reroll advisor weighs the
+    # live cards like the draws do, and packs keep their weights through the compiled cache
+    problems = []
+    weights = np.array([1.0, 3.0, 0.0, 2.0, 0.5])
+    catalog = weighted_catalog(weights, tiers=(1, 2, 3, 4, 5, 6))
+    decks = make_decks(catalog, np.random.default_rng(0))
+    deck = decks['df1']
+    if 2 in deck.pool:
+        problems.append('a card weighted 0 is in the deck')
+
+    deck.draw()
+    values, mass = deck.tally()
+    live = {float(catalog['cul'].iloc[row]): weights[row] for row in deck.live()}
+    got = {float(v): m for v, m in zip(values[:, 0], mass) if m > 0}
+    if got.keys() != live.keys() or not all(np.isclose(got[v], live[v]) for v in live):
+        problems.append(f'tally {got} != live weights {live}')
+    totals, probs = hand_distribution(decks)
+    if not np.isclose(probs.sum(), 1):
+        problems.append(f'hand distribution sums to {probs.sum()}')
+
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, 'pack.csv')
+        catalog.to_csv(source, index=False)
+        loaded = load_catalog(source)
+        if WEIGHT_COLUMN not in loaded or not np.array_equal(loaded[WEIGHT_COLUMN].to_numpy(), catalog[WEIGHT_COLUMN].to_numpy()):
+            problems.append('the weight column did not survive the catalog cache')
+    return problems
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Checks that weighted (rarity) draws follow their weights')
+    parser.add_argument('--draws', type=int, default=400_000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    failed = 0
+    for name, (stat, dof, critical, ok) in checks(args.draws, args.seed):
+        print(f'{name:<45} chi2 {stat:10.2f}  dof {dof:3d}  critical {critical:8.2f}  {"ok" if ok else "FAIL"}')
+        failed += not ok
+    for problem in exact_checks():
+        print('FAIL', problem)
+        failed += 1
+    print('level', ALPHA, 'per test;', 'all passed' if not failed else f'{failed} failed')
+    raise SystemExit(1 if failed else 0)
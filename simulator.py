@@ -0,0 +1,173 @@
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from civ_core.catalog import load_catalog
+from civ_core.random_generator import make_decks, deal_batch, odds_matrix, catalog_weights, CATEGORIES, HAND_DECKS, WIN_TYPES
+
+SHARE_BINS = np.linspace(0, 1, 101)
+
+
+def catalog_arrays(catalog):
+    decks = make_decks(catalog)
+    pools = [decks[name].rows() for name in HAND_DECKS]
+    values = catalog[CATEGORIES].to_numpy(dtype=np.float64)
+    # Rarity weights of the pooled cards, None when the catalog has none
+    weights = catalog_weights(catalog)
+    weights = None if weights is None else [weights[pool] for pool in pools]
+
+    return pools, values, weights
+
+
+def simulate_chunk(pools, values, players, games, seed, batch=50_000, weights=None):
+    rng = np.random.default_rng(seed)
+    n_rows = len(values)
+
+    result = {
+        'games': 0,
+        'share_hist': np.zeros(len(SHARE_BINS) - 1, dtype=np.int64),
+        'winner_hist': np.zeros(len(SHARE_BINS) - 1, dtype=np.int64),
+        'share_sum': 0.0,
+        'share_sq_sum': 0.0,
+        'winner_sum': 0.0,
+        'winner_sq_sum': 0.0,
+        'win_type': np.zeros(len(WIN_TYPES), dtype=np.int64),
+        'dealt': np.zeros(n_rows, dtype=np.int64),
+        'won': np.zeros(n_rows, dtype=np.int64),
+    }
+
+    done = 0
+    while done < games:
+        size = min(batch, games - done)
+        hands = deal_batch(pools, players, size, rng, weights=weights)
+        totals = values[hands].sum(axis=2)
+        _, best, overall = odds_matrix(totals)
+
+        winner = overall.argmax(axis=1)
+        winner_share = overall[np.arange(size), winner]
+        winner_hands = hands[np.arange(size), winner]
+
+        result['games'] += size
+        result['share_hist'] += np.histogram(overall, SHARE_BINS)[0]
+        result['winner_hist'] += np.histogram(winner_share, SHARE_BINS)[0]
+        result['share_sum'] += overall.sum()
+        result['share_sq_sum'] += np.square(overall).sum()
+        result['winner_sum'] += winner_share.sum()
+        result['winner_sq_sum'] += np.square(winner_share).sum()
+        result['win_type'] += np.bincount(best[np.arange(size), winner], minlength=len(WIN_TYPES))
+        result['dealt'] += np.bincount(hands.ravel(), minlength=n_rows)
+        result['won'] += np.bincount(winner_hands.ravel(), minlength=n_rows)
+
+        done += size
+
+    return result
+
+
+def merge_results(results):
+    merged = results[0]
+    for result in results[1:]:
+        for key, value in result.items():
+            merged[key] = merged[key] + value
+
+    return merged
+
+
+def simulate(games, players, workers=None, seed=None, catalog=None, batch=50_000):
+    catalog = load_catalog() if catalog is None else catalog
+    pools, values, weights = catalog_arrays(catalog)
+    if players > min(len(pool) for name, pool in zip(HAND_DECKS, pools) if name != 'df4'):
+        raise ValueError(f"Not enough cards to deal {players} players")
+
+    workers = workers or os.cpu_count() or 1
+    chunks = [games // workers + (1 if i < games % workers else 0) for i in range(workers)]
+    seeds = np.random.SeedSequence(seed).spawn(workers)
+
+    if workers == 1:
+        results = [simulate_chunk(pools, values, players, chunks[0], seeds[0], batch, weights)]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(simulate_chunk, pools, values, players, n, s, batch, weights)
+                       for n, s in zip(chunks, seeds) if n > 0]
+            results = [f.result() for f in futures]
+
+    return summarize(merge_results(results), players, catalog)
+
+
+def _mean_var(total, sq_total, count):
+    mean = total / count
+    return mean, sq_total / count - mean ** 2
+
+
+def summarize(result, players, catalog):
+    games = result['games']
+    share_mean, share_var = _mean_var(result['share_sum'], result['share_sq_sum'], games * players)
+    winner_mean, winner_var = _mean_var(result['winner_sum'], result['winner_sq_sum'], games)
+
+    dealt = result['dealt']
+    cards = catalog[['tier', 'bonus']].copy()
+    cards['dealt'] = dealt
+    cards['won'] = result['won']
+    # How often a hand holding the card ends up the overall winner; 1 / players is par
+    cards['win_rate'] = np.divide(result['won'], dealt, out=np.zeros(len(dealt)), where=dealt > 0)
+    cards = cards[cards['dealt'] > 0].sort_values('win_rate', ascending=False)
+
+    return {
+        'games': games,
+        'players': players,
+        'share_mean': share_mean,
+        'share_var': share_var,
+        'winner_share_mean': winner_mean,
+        'winner_share_var': winner_var,
+        'share_hist': result['share_hist'],
+        'winner_hist': result['winner_hist'],
+        'win_type': dict(zip(WIN_TYPES, result['win_type'].tolist())),
+        'cards': cards,
+    }
+
+
+def report_json(reports):
+    out = []
+    for report in reports:
+        item = dict(report)
+        item['share_hist'] = report['share_hist'].tolist()
+        item['winner_hist'] = report['winner_hist'].tolist()
+        item['cards'] = report['cards'].to_dict(orient='records')
+        out.append(item)
+
+    return out
+
+
+def print_report(report):
+    print(f"\n=== {report['players']} players, {report['games']:,} games ===")
+    print(f"overall share: mean {report['share_mean']:.3f}, var {report['share_var']:.5f}")
+    print(f"winner share:  mean {report['winner_share_mean']:.3f}, var {report['winner_share_var']:.5f}")
+    print("winning victory type:", report['win_type'])
+
+    cards = report['cards']
+    with pd.option_context('display.max_colwidth', 60, 'display.width', 160):
+        print("\nStrongest cards (win rate when dealt):")
+        print(cards.head(10).to_string())
+        print("\nWeakest cards:")
+        print(cards.tail(10).to_string())
+        print("\nNations:")
+        print(cards[cards['tier'] == 5].to_string())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Monte Carlo balance check for Civ_bonuses.xlsx')
+    parser.add_argument('--games', type=int, default=1_000_000)
+    parser.add_argument('--players', type=int, nargs='+', default=[3, 4, 5])
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--json', default=None, help='write the full reports to this file')
+    args = parser.parse_args()
+
+    reports = [simulate(args.games, p, args.workers, args.seed) for p in args.players]
+    for report in reports:
+        print_report(report)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report_json(reports), f, ensure_ascii=False, indent=2)
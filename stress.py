@@ -0,0 +1,115 @@
+import argparse
+import multiprocessing
+import os
+import random
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from civ_core import state_manager
+
+
+def _use_dir(directory):
+    state_manager.STATE_FILE = os.path.join(directory, 'game_state.pkl')
+    state_manager.STATE_DB = os.path.join(directory, 'game_state.db')
+    state_manager.PLAYER_NAMES_FILE = os.path.join(directory, 'player_names.json')
+    # Many writer processes share one file here: every commit has to reach it
+    state_manager.WRITE_MAX_DELAY = 0
+
+
+def mutator(directory, actions, seed):
+    # Returns how many commits this mutator made; lock toggles and events always commit,
+    # a reroll commits only while the decks last and the player is unlocked
+    _use_dir(directory)
+    rnd = random.Random(seed)
+    commits = 0
+    for _ in range(actions):
+        player = rnd.randrange(len(state_manager.load_state()['players']))
+        action = rnd.choice(['reroll', 'lock', 'event'])
+        if action == 'reroll':
+            # Same as reroll_player(), but remembers whether the committed attempt changed anything
+            applied = []
+
+            def apply(state):
+                result = state_manager._reroll(state, player)
+                applied.append(result is not False)
+                return result
+
+            state_manager.mutate_state(apply)
+            commits += int(applied[-1])
+        elif action == 'lock':
+            state_manager.toggle_lock(player, lock=rnd.random() < 0.3)
+            commits += 1
+        else:
+            state_manager.generate_new_event()
+            commits += 1
+
+    return commits
+
+
+def dealt_cards(state):
+    # Cards of the without-replacement tiers currently on the table
+    cards = []
+    for table in state['tables'].values():
+        if table is not None:
+            cards += list(table['bonus'].iloc[[0, 1, 2, 4]])
+    return cards
+
+
+def _cold_step(directory, action):
+    # One action in a fresh interpreter, so the game comes from the state file and not from
+    # a copy in memory; returns what undo has to put back exactly
+    _use_dir(directory)
+    if action == 'deal':
+        state_manager.initialize_state([f'P{i}' for i in range(4)], seed=1)
+    elif action == 'reroll':
+        state_manager.reroll_player(0)
+    else:
+        getattr(state_manager, action)()
+    state = state_manager.load_state()
+    return ({name: len(deck) for name, deck in state['decks'].items()},
+            {i: None if rows is None else rows.tolist() for i, rows in state['tables'].hands.items()})
+
+
+def undo_check():
+    # Deal, reroll, undo, redo, each loaded cold: undo gives back the dealt game, redo the reroll
+    with tempfile.TemporaryDirectory() as directory:
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=1, mp_context=context, max_tasks_per_child=1) as pool:
+            dealt, rerolled, undone, redone = [pool.submit(_cold_step, directory, action).result()
+                                               for action in ('deal', 'reroll', 'undo', 'redo')]
+        return dealt != rerolled and undone == dealt and redone == rerolled
+
+
+def run(mutators=50, actions=20, players=4):
+    with tempfile.TemporaryDirectory() as directory:
+        _use_dir(directory)
+        state = state_manager.initialize_state([f'P{i}' for i in range(players)])
+        start = state['version']
+
+        with ProcessPoolExecutor(max_workers=mutators) as pool:
+            futures = [pool.submit(mutator, directory, actions, seed) for seed in range(mutators)]
+            commits = sum(f.result() for f in futures)
+
+        state = state_manager.load_state()
+        cards = dealt_cards(state)
+
+        return {
+            'mutators': mutators,
+            'commits': commits,
+            'versions': state['version'] - start,
+            'duplicate_cards': len(cards) - len(set(cards)),
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Concurrent mutators against one state file')
+    parser.add_argument('--mutators', type=int, default=50)
+    parser.add_argument('--actions', type=int, default=20)
+    args = parser.parse_args()
+
+    result = run(args.mutators, args.actions)
+    print(result)
+    lost = result['commits'] - result['versions']
+    print('lost updates:', lost)
+    undo_ok = undo_check()
+    print('undo/redo after a cold load:', 'ok' if undo_ok else 'FAILED')
+    raise SystemExit(1 if lost or result['duplicate_cards'] or not undo_ok else 0)
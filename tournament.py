@@ -0,0 +1,213 @@
+import argparse
+import csv
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from civ_core import state_manager
+from civ_core.catalog import load_catalog, tier_rows, CATALOG
+from civ_core.random_generator import odds_matrix, spread, CATEGORIES, WIN_TYPES
+from civ_core.rooms import check_room
+
+# Players at a table, as on the page
+MIN_PLAYERS = 2
+MAX_PLAYERS = 5
+# Balanced pods search a fixed number of rounds instead of for BALANCE_BUDGET seconds,
+# so the same seed deals the same tournament on any machine
+DEAL_ROUNDS = 100
+# Hand rows in table order: three bonuses, the technology and the nation
+HAND_LABELS = ['bonus 1', 'bonus 2', 'bonus 3', 'technology', 'nation']
+# Tiers that are never repeated within a pod (decks without replacement)
+UNIQUE_SLOTS = [0, 1, 2, 4]
+
+# Catalog of this process, loaded once per worker
+_catalog = []
+
+
+def pod_seeds(seed, pods):
+    # One 128-bit seed per pod, derived from the tournament seed and the pod's number only,
+    # so pod 7 gets the same deal however many pods or workers there are
+    seeds = []
+    for child in np.random.SeedSequence(seed).spawn(pods):
+        low, high = child.generate_state(2, np.uint64).tolist()
+        seeds.append(low | high << 64)
+    return seeds
+
+
+def split_pods(names, size):
+    # Players in file order into as few pods of at most `size` as possible, sizes differing by at most one
+    pods = -(-len(names) // size)
+    base, extra = divmod(len(names), pods)
+    bounds = np.cumsum([0] + [base + (i < extra) for i in range(pods)])
+    return [names[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def _worker_catalog():
+    if not _catalog:
+        _catalog.append(load_catalog())
+    return _catalog[0]
+
+
+def pod_report(number, state, catalog, room=None):
+    # The pod as plain JSON values: who sits where, their hands and odds, the event
+    bonus = catalog['bonus'].to_numpy()
+    players = state['players']
+    totals = state['totals']
+    shares, best, overall = odds_matrix(totals)
+    hands = state['tables'].hands
+    return {
+        'pod': number,
+        'room': room,
+        'seed': state['seed'],
+        'setup': state['setup'],
+        'players': players,
+        'map_maker': players[state['game_info']['map_maker']],
+        'first_player': players[state['game_info']['first_player']],
+        'event': str(bonus[state['random_event']]),
+        'spread': float(spread(totals)),
+        'hands': [{
+            'player': name,
+            'rows': hands[i].tolist(),
+            **{label: str(bonus[row]) for label, row in zip(HAND_LABELS, hands[i])},
+            'totals': dict(zip(CATEGORIES, totals[i].tolist())),
+            'overall': round(float(overall[i]), 4),
+            'victory_type': WIN_TYPES[best[i]],
+        } for i, name in enumerate(players)],
+    }
+
+
+def repeats(report):
+    # Bonuses and nations dealt more than once within the pod; always 0, checked anyway
+    rows = np.array([hand['rows'] for hand in report['hands']])[:, UNIQUE_SLOTS]
+    return sum(len(column) - len(set(column)) for column in rows.T.tolist())
+
+
+def deal_pod(number, names, seed, balanced, deal_rounds, keep_state=False, room=None):
+    # One table dealt exactly like New Game with this seed (initialize_state without the save)
+    catalog = _worker_catalog()
+    state = state_manager.build_state(names, balanced, seed, deal_rounds if balanced else None, catalog=catalog)
+    return pod_report(number, state, catalog, room), state if keep_state else None
+
+
+def _deal_chunk(tasks):
+    return [deal_pod(*task) for task in tasks]
+
+
+def run(pods, seed=None, balanced=False, deal_rounds=DEAL_ROUNDS, workers=None, rooms=None):
+    # pods: one list of player names per table. Returns the consolidated report, and with
+    # `rooms` (a room id prefix) also saves pod n as the playable game of room <rooms>-<n>.
+    catalog = load_catalog()
+    cards = min(len(tier_rows(catalog, tier)) for tier in (1, 2, 3, 5))
+    for number, names in enumerate(pods, 1):
+        if not MIN_PLAYERS <= len(names) <= min(MAX_PLAYERS, cards):
+            raise ValueError(f'pod {number} has {len(names)} players; '
+                             f'a pod seats {MIN_PLAYERS} to {min(MAX_PLAYERS, cards)}')
+    seed = int(state_manager.new_seed() if seed is None else seed)
+    room_ids = [check_room(f'{rooms}-{n}') if rooms else None for n in range(1, len(pods) + 1)]
+    tasks = [(n, names, pod_seed, balanced, deal_rounds, bool(rooms), room)
+             for n, (names, pod_seed, room) in enumerate(zip(pods, pod_seeds(seed, len(pods)), room_ids), 1)]
+
+    started = time.perf_counter()
+    workers = min(workers or os.cpu_count() or 1, len(tasks))
+    if workers <= 1:
+        results = _deal_chunk(tasks)
+    else:
+        # A few chunks per worker: balanced pods take longer than others
+        chunks = [tasks[i::workers * 4] for i in range(workers * 4)]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            done = [result for chunk in pool.map(_deal_chunk, chunks) for result in chunk]
+        results = sorted(done, key=lambda result: result[0]['pod'])
+    elapsed = time.perf_counter() - started
+
+    if rooms:
+        for report, state in results:
+            state_manager.replace_state(state, report['room'])
+        # Writing the games creates the rooms directory the names go to; New Game at the
+        # table then deals the same players again
+        state_manager.flush()
+        for (report, state), names in zip(results, pods):
+            state_manager.save_player_names(names, report['room'])
+
+    reports = [report for report, state in results]
+    spreads = np.array([report['spread'] for report in reports])
+    return {
+        'tournament': {
+            'seed': seed,
+            'pods': len(reports),
+            'players': sum(len(names) for names in pods),
+            'balanced': balanced,
+            'deal_rounds': deal_rounds if balanced else None,
+            'catalog': CATALOG,
+        },
+        'summary': {
+            'spread_mean': float(spreads.mean()),
+            'spread_max': float(spreads.max()),
+            'repeats': sum(repeats(report) for report in reports),
+            'workers': workers,
+            'seconds': round(elapsed, 3),
+        },
+        'pods': reports,
+    }
+
+
+def write_csv(report, path):
+    # One row per seat, for printing table cards; utf-8-sig so Excel reads the Cyrillic text
+    with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['pod', 'room', 'seat', 'player', *HAND_LABELS, *CATEGORIES, 'overall', 'victory_type',
+                         'map_maker', 'first_player', 'event', 'seed'])
+        for pod in report['pods']:
+            for seat, hand in enumerate(pod['hands'], 1):
+                writer.writerow([pod['pod'], pod['room'] or '', seat, hand['player'], *[hand[label] for label in HAND_LABELS],
+                                 *hand['totals'].values(), hand['overall'], hand['victory_type'],
+                                 pod['map_maker'], pod['first_player'], pod['event'], pod['seed']])
+
+
+def write_report(report, path):
+    if path.lower().endswith('.csv'):
+        write_csv(report, path)
+        return
+    # Run details that change between otherwise identical runs stay out of the file
+    report = dict(report, summary={key: value for key, value in report['summary'].items()
+                                   if key not in ('workers', 'seconds')})
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+def read_names(path):
+    with open(path, encoding='utf-8-sig') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Deal many tables at once for a club event')
+    parser.add_argument('--names', default=None, help='file with one player name per line, seated in that order')
+    parser.add_argument('--pods', type=int, default=None, help='number of tables (without --names)')
+    parser.add_argument('--players', type=int, default=4, help='players per table (at most)')
+    parser.add_argument('--shuffle', action='store_true', help='draw the tables from the names with the seed')
+    parser.add_argument('--balanced', action='store_true', help='balanced deal at every table')
+    parser.add_argument('--deal-rounds', type=int, default=DEAL_ROUNDS, help='search rounds of a balanced deal')
+    parser.add_argument('--seed', type=int, default=None, help='the same seed deals the same tournament')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--rooms', default=None, help='also save pod n as the game of room <ROOMS>-<n>')
+    parser.add_argument('--out', default='tournament.json', help='.json (everything) or .csv (one row per seat)')
+    args = parser.parse_args()
+
+    if args.names:
+        names = read_names(args.names)
+    elif args.pods:
+        names = [f'Table {n} Player {k}' for n in range(1, args.pods + 1) for k in range(1, args.players + 1)]
+    else:
+        parser.error('give --names or --pods')
+    seed = int(state_manager.new_seed() if args.seed is None else args.seed)
+    if args.shuffle:
+        names = [names[i] for i in np.random.default_rng(seed).permutation(len(names))]
+
+    report = run(split_pods(names, args.players), seed, args.balanced, args.deal_rounds, args.workers, args.rooms)
+    write_report(report, args.out)
+    summary = report['summary']
+    print(f"{report['tournament']['pods']} pods, {report['tournament']['players']} players, seed {seed}: "
+          f"dealt in {summary['seconds']:.2f} s on {summary['workers']} workers -> {args.out}")
+    print(f"spread mean {summary['spread_mean']:.2f}, max {summary['spread_max']:.2f}; "
+          f"{summary['repeats']} repeated bonuses or nations")
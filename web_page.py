@@ -1,13 +1,43 @@
 import pandas as pd
 import streamlit as st
 import numpy as np
-import time
-import os
-import base64
-import state_manager
-from random_generator import find_odds
+from civ_core import notify, state_manager
+from civ_core.catalog import load_catalog, split_tiers
+from civ_core.metrics import metrics, span, timed
+from civ_core.random_generator import event_frame, player_seating, reroll_odds
+from civ_core.rooms import DEFAULT_ROOM, check_room
+from assets import asset_url
+from streamlit.runtime import Runtime
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from streamlit.proto.ClientState_pb2 import ClientState
 
-def display_table(table, player_flag, player_name, player_index, locked=False) -> None:
+# Without a runtime to push reruns, a run waits this long (s) for the room to change
+SYNC_WAIT = 30
+
+def parse_sheet():
+    pd.set_option('display.max_colwidth', None)
+    pd.options.mode.chained_assignment = None
+
+    df = load_catalog()
+    # df.style.set_properties(**{'text-align': 'right'})
+
+    df1, df2, df3, df4, df5, df6 = split_tiers(df)
+
+    state = st.session_state
+
+    if "df1" not in state:
+        state.df1 = df1
+    if "df2" not in state:
+        state.df2 = df2
+    if "df3" not in state:
+        state.df3 = df3
+    if "df5" not in state:
+        state.df5 = df5
+
+    return state.df1, state.df2, state.df3, df4, state.df5, df6
+
+
+def display_table(table, player_flag, player_name, player_index, locked=False, room=DEFAULT_ROOM, advice=None) -> None:
     start, col1, mid, col2, end = st.columns([0.5, 3.5, 1, 12, 3])
 
     # Reroll button
@@ -19,19 +49,22 @@ def display_table(table, player_flag, player_name, player_index, locked=False) -
     click = end.button("Reroll", key=f"reroll_{player_index}", disabled=locked)
     lock_label = "🔓 Unlock" if locked else "🔒 Lock"
     toggle = end.button(lock_label, key=f"lock_{player_index}")
+    if advice is not None and not locked:
+        end.caption(f"Reroll: {advice['overall_now']:.0%} → {advice['overall_expected']:.0%} expected, "
+                    f"better in {advice['p_better']:.0%}")
     if toggle:
-        state_manager.toggle_lock(player_index, lock=not locked)
+        state_manager.toggle_lock(player_index, lock=not locked, room=room)
         st.rerun()
 
     if click:
-        state_manager.reroll_player(player_index)
+        state_manager.reroll_player(player_index, room=room)
         st.rerun()
 
     # If table is None (e.g. error), return
     if table is None:
         return
 
-    final = table.drop(columns=['cul', 'eco', 'war', 'tech'], axis=1)
+    final = table.drop(columns=['cul', 'eco', 'war', 'tech'])
     final = final.rename(columns={"bonus": player_name})
     
     # Extract values for custom rendering
@@ -47,10 +80,10 @@ def display_table(table, player_flag, player_name, player_index, locked=False) -
         st.markdown("<div style='margin-bottom: 3rem;'></div>", unsafe_allow_html=True)
         return
 
-    # Nation image (outside collapsible card)
+    # Nation image (outside collapsible card), served as a cached static asset
     try:
-        image_path = 'static/img/' + str(nation) + '.png'
-        col1.image(image_path, width='stretch')
+        image_url = asset_url(str(nation) + '.png', _static_serving())
+        col1.markdown(f'<img src="{image_url}" style="width: 100%;" alt="{nation}">', unsafe_allow_html=True)
     except Exception:
         col1.write("Image not found")
 
@@ -109,6 +142,41 @@ def display_table(table, player_flag, player_name, player_index, locked=False) -
     st.markdown("<div style='margin-bottom: 3rem;'></div>", unsafe_allow_html=True)
 
 
+def _static_serving():
+    # Downscaled images go out as /app/static URLs when the server serves ./static, else as memoized data URIs
+    return bool(st.get_option('server.enableStaticServing'))
+
+
+def _session_waker():
+    # Callable that reruns this browser session from any thread; reports False once the session is gone.
+    # The rerun keeps the page and its query string (request_rerun(None) would run it with an
+    # empty one, losing ?room=) and no widget input, so nothing clicked is clicked again.
+    # Sessions are only reachable through the runtime's private session manager; None when
+    # it is missing, as without a runtime.
+    ctx = get_script_run_ctx()
+    if ctx is None or not Runtime.exists():
+        return None
+    sessions = getattr(Runtime.instance(), '_session_mgr', None)
+    if not hasattr(sessions, 'get_active_session_info'):
+        return None
+    session_id = ctx.session_id
+    client_state = ClientState(query_string=ctx.query_string, page_script_hash=ctx.page_script_hash)
+
+    def wake():
+        try:
+            info = sessions.get_active_session_info(session_id)
+            if info is None:
+                return False
+            info.session.request_rerun(client_state)
+            return True
+        except Exception:
+            return False
+
+    wake.session_id = session_id
+    return wake
+
+
+@timed('render.page')
 def create_web_page(df1, df2, df3, df4, df5, df6, initial_players):
     # Icon List: 🏛️🕌🛕🌍🏙🏰🏦
     st.set_page_config(
@@ -481,27 +549,48 @@ def create_web_page(df1, df2, df3, df4, df5, df6, initial_players):
         </style>
     """, unsafe_allow_html=True)
 
+    # One watcher per server process picks up commits from other processes
+    state_manager.watch_changes()
+    # Timing spans go to the local metrics endpoint / log when configured (CIV_METRICS_PORT, CIV_METRICS_LOG)
+    metrics.start()
+    ctx = get_script_run_ctx()
+    if ctx is not None:
+        metrics.rerun(ctx.session_id)
+
+    # Every table plays in its own room, chosen with ?room=<id> in the URL (no room: the default game).
+    # The session keeps its room, so a rerun that arrives without the query string stays in it.
+    try:
+        room = check_room(st.query_params.get('room') or st.session_state.get('room'))
+    except ValueError as e:
+        st.error(str(e))
+        st.stop()
+    st.session_state.room = room
+
     # Load shared state
-    shared_state = state_manager.load_state()
+    try:
+        shared_state = state_manager.load_state(room)
+    except state_manager.StateCorruptError as e:
+        # Never deal over a game we merely failed to read
+        st.error(f"Could not read the saved game: {e}")
+        st.stop()
     if shared_state is None:
         # Initialize if not exists
-        shared_state = state_manager.initialize_state(initial_players)
+        shared_state = state_manager.initialize_state(initial_players, room=room)
 
-    # Track state file modification time for auto-refresh
-    try:
-        st.session_state.last_mtime = os.path.getmtime(state_manager.STATE_FILE)
-    except OSError:
-        st.session_state.last_mtime = 0
+    # Track the state version for auto-refresh (works for every storage backend)
+    st.session_state.last_version = shared_state.get('version')
 
     players = shared_state['players']
     tables = shared_state['tables']
     player_flags = shared_state['player_flags']
     game_info = shared_state['game_info']
-    random_event = shared_state['random_event']
+    # The state keeps the event as a catalog row and no seating plan; both are drawn from these
+    random_event = event_frame(shared_state['decks']['df6'].catalog, shared_state['random_event'])
+    seating = player_seating(players)
 
     tab0, tab1, tab2 = st.tabs(["📜 Сюжет", "🏛️ Цивилизации", "🗺️ Карта Территории"])
 
-    with tab0:
+    with tab0, span('render.lore'):
         st.markdown('<div class="lore-title">Летопись Острова</div>', unsafe_allow_html=True)
         st.markdown('<div class="lore-subtitle">Штормы времени раздвинули эпохи, и правители, ведомые амбициями, одновременно ступили на землю, где история рождается заново.</div>', unsafe_allow_html=True)
         general = "В мире существует Архипелаг Времён — кластер островов, затерянных не только в пространстве, но и во времени. Его местоположение скрыто Хронозавесой, мистической аномалией, созданной древней цивилизацией-хранителем, пытавшейся уберечь человечество от самоуничтожения. Когда Земля достигает точки критического напряжения - будь то ядерная угроза, экологический коллапс или глобальный конфликт - Хронозавеса активируется и призывает из разных эпох величайших стратегов, реформаторов и завоевателей, перенося их в «петлю времени» на архипелаге. Им даётся одно задание - найти путь, который приведет человечество к процветанию, объединив все народы, будь то через войну, культуру, технологии или экономику. Тот, чья философия окажется наиболее жизнеспособной, не только вернётся в свою эпоху с новыми знаниями, но и изменит ход мировой истории. Однако Хронозавеса не выбирает слабых - только тех, чьи имена навсегда вписаны в летописи величия."
@@ -556,31 +645,35 @@ def create_web_page(df1, df2, df3, df4, df5, df6, initial_players):
         lore_html += '</div>'
         st.markdown(lore_html, unsafe_allow_html=True)
 
-    with tab1:
+    with tab1, span('render.tables'):
         st.header("The Council of Leaders")
+        # Expected odds of a reroll, only once every player has a table to compare against
+        dealt = len(players) >= 2 and all(tables.get(i) is not None for i in range(len(players)))
+        game = state_manager.game_key(shared_state)
         for i, player_name in enumerate(players):
             if i in tables:
                 table_i = tables[i]
                 if table_i is not None and str(player_name).strip():
                     locked = shared_state.get('locked', {}).get(i, False)
-                    display_table(table_i, player_flags[i], player_name, i, locked)
+                    advice = None
+                    if dealt and not locked:
+                        with span('render.advice'):
+                            advice = reroll_odds(shared_state['totals'], i, shared_state['decks'], game)
+                    display_table(table_i, player_flags[i], player_name, i, locked, room, advice)
 
-    with tab2:
+    with tab2, span('render.overview'):
         st.header("Strategic Overview")
         
         # Center the map and restrict width
         col_map_container = st.container()
         
         with col_map_container:
-            seating = game_info['seating']
             map_maker_idx = game_info['map_maker']
             first_player_idx = game_info['first_player']
-            map_b64 = None
             try:
-                with open("static/img/map.png", "rb") as f:
-                    map_b64 = base64.b64encode(f.read()).decode()
+                map_url = asset_url('map.png', _static_serving())
             except Exception:
-                map_b64 = None
+                map_url = None
              
             # Ensure indices are valid
             map_maker_name = players[map_maker_idx] if map_maker_idx < len(players) else players[0]
@@ -617,8 +710,8 @@ def create_web_page(df1, df2, df3, df4, df5, df6, initial_players):
                 for c in range(cols):
                     # Check if this is part of the 2x2 table block (r=1,2 and c=1,2)
                     if r == 1 and c == 1:
-                        if map_b64:
-                            seating_html += f'<div class="seating-cell cell-table" style="grid-column: span 2; grid-row: span 2; background-image: url(\'data:image/png;base64,{map_b64}\'); background-size: cover; background-position: center;"></div>'
+                        if map_url:
+                            seating_html += f'<div class="seating-cell cell-table" style="grid-column: span 2; grid-row: span 2; background-image: url(\'{map_url}\'); background-size: cover; background-position: center;"></div>'
                         else:
                             seating_html += '<div class="seating-cell cell-table" style="grid-column: span 2; grid-row: span 2;"></div>'
                     elif (r == 1 and c == 2) or (r == 2 and c == 1) or (r == 2 and c == 2):
@@ -644,24 +737,21 @@ def create_web_page(df1, df2, df3, df4, df5, df6, initial_players):
         st.divider()
 
         # Odds section at the bottom
-        if len(players) == 4:
-            # Need to pass tables in correct order: 1, 2, 3, 4
-            # tables dict keys are 0, 1, 2, 3
-            if 0 in tables and 1 in tables and 2 in tables and 3 in tables:
-                table, winner = find_odds(tables[0], tables[1], tables[2], tables[3], players)
-
-                st.markdown('<div class="seating-header" style="color: #c9a959; font-size: 1.2rem; margin-bottom: 0.5rem;">Victory Probabilities (Single Type)</div>', unsafe_allow_html=True)
-                st.dataframe(table, width='stretch')
-
-                st.markdown('<div class="seating-header" style="color: #c9a959; font-size: 1.2rem; margin-top: 1rem; margin-bottom: 0.5rem;">Overall Victory Odds</div>', unsafe_allow_html=True)
-                st.dataframe(winner, column_order=('2', '1', '0'),
-                             column_config={'0': 'Probability', '1': 'Victory Type', '2': 'Leader'}, width='stretch')
+        if len(players) >= 2 and all(tables.get(i) is not None for i in range(len(players))):
+            with span('render.odds'):
+                table, winner = state_manager.game_odds(shared_state, room)
+
+            st.markdown('<div class="seating-header" style="color: #c9a959; font-size: 1.2rem; margin-bottom: 0.5rem;">Victory Probabilities (Single Type)</div>', unsafe_allow_html=True)
+            st.dataframe(table.style.format('{:.0%}'), width='stretch')
+
+            st.markdown('<div class="seating-header" style="color: #c9a959; font-size: 1.2rem; margin-top: 1rem; margin-bottom: 0.5rem;">Overall Victory Odds</div>', unsafe_allow_html=True)
+            st.dataframe(winner.style.format({'Probability': '{:.0%}'}), hide_index=True, width='stretch')
         else:
-             st.info("Victory odds are only available for 4 players.")
+             st.info("Victory odds need at least 2 players with a deal.")
 
 
     # Sidebar content
-    with st.sidebar.container():
+    with st.sidebar.container(), span('render.sidebar'):
         st.markdown("""
           <style>
             .st-emotion-cache-1mi2ry5.eczjsme9 {
@@ -670,18 +760,31 @@ def create_web_page(df1, df2, df3, df4, df5, df6, initial_players):
           </style>
         """, unsafe_allow_html=True)
 
-        st.image('static/img/logo.png')
+        st.markdown(f'<img src="{asset_url("logo.png", _static_serving())}" style="width: 100%;">', unsafe_allow_html=True)
         
         # New Game button
+        balanced = st.checkbox('Balanced deal', value=shared_state.get('balanced', False), key='balanced_deal')
         if st.button('New Game', key='new_game_top', use_container_width=True):
-             state_manager.reset_game(initial_players)
+             state_manager.reset_game(initial_players, balanced, room=room)
+             st.rerun()
+        undo_col, redo_col = st.columns(2)
+        if undo_col.button('↶ Undo', key='undo_btn', use_container_width=True,
+                           disabled=not state_manager.can_undo(shared_state)):
+             state_manager.undo(room=room)
+             st.rerun()
+        if redo_col.button('↷ Redo', key='redo_btn', use_container_width=True,
+                           disabled=not state_manager.can_redo(shared_state)):
+             state_manager.redo(room=room)
              st.rerun()
+        if shared_state.get('seed') is not None:
+            # Quote this with a bug report: seed plus action log replays the game exactly
+            st.caption(f"Game seed: {shared_state['seed']}")
 
         st.divider()
         st.header("Global Event")
 
         if st.button("Generate Event", key="gen_event_btn", use_container_width=True):
-             state_manager.generate_new_event()
+             state_manager.generate_new_event(room=room)
              st.rerun()
 
         event_text = random_event.loc[':', list(random_event)[1]]
@@ -689,7 +792,6 @@ def create_web_page(df1, df2, df3, df4, df5, df6, initial_players):
 
         st.divider()
 
-        seating = game_info['seating']
         map_maker_idx = game_info['map_maker']
         first_player_idx = game_info['first_player']
         
@@ -777,23 +879,23 @@ def create_web_page(df1, df2, df3, df4, df5, df6, initial_players):
                 if len(valid_names) < 3:
                      valid_names = valid_names + [f"Player {i+1}" for i in range(len(valid_names), 3)]
                 
-                state_manager.update_player_names(valid_names)
+                state_manager.update_player_names(valid_names, room=room)
                 st.rerun()
 
             if remove_button:
                 # Remove last player
                 if len(players) > 0:
                     new_list = players[:-1]
-                    state_manager.update_player_names(new_list)
+                    state_manager.update_player_names(new_list, room=room)
                     st.rerun()
 
-    # Continuous file-change sync across clients
-    while True:
-        time.sleep(2)
-        try:
-            new_mtime = os.path.getmtime(state_manager.STATE_FILE)
-            if new_mtime > st.session_state.last_mtime:
-                st.session_state.last_mtime = new_mtime
-                st.rerun()
-        except OSError:
-            pass
+    # Push-based sync across clients: instead of polling, this session is rerun by the
+    # process-wide change hub as soon as any session or process commits a new version
+    wake = _session_waker()
+    if wake is not None:
+        notify.hub.subscribe(room, wake.session_id, st.session_state.last_version, wake)
+    elif not Runtime.exists():
+        # No Streamlit runtime to call back into (e.g. bare mode): block until a change, for a while
+        if notify.hub.wait(room, st.session_state.last_version, SYNC_WAIT) != st.session_state.last_version:
+            st.rerun()
+    # Otherwise this Streamlit keeps its sessions out of reach: changes show on the next run